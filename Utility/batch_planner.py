@@ -0,0 +1,90 @@
+import math
+import threading
+
+
+class BatchPlanner:
+    """Chooses per-topic batch sizes from observed output size, latency and failures.
+
+    Keeps an exponentially weighted history per (questionType, difficulty)
+    and sizes batches so a single call fills the model's output budget
+    without running into truncation.
+    """
+
+    def __init__(self, max_output_tokens=4096, safety_margin=0.8, max_batch_size=15,
+                 default_tokens_per_question=250, target_batch_seconds=None, smoothing=0.3,
+                 min_backoff_size=3):
+        self.max_output_tokens = max_output_tokens
+        self.safety_margin = safety_margin
+        self.max_batch_size = max_batch_size
+        self.default_tokens_per_question = default_tokens_per_question
+        self.target_batch_seconds = target_batch_seconds
+        self.smoothing = smoothing
+        # Failures shrink batches down to this size at most, never to one question per call
+        self.min_backoff_size = min_backoff_size
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(question_type, difficulty):
+        return f"{str(question_type).strip().lower()}|{str(difficulty).strip().lower()}"
+
+    def batch_size(self, question_type, difficulty):
+        with self._lock:
+            stats = dict(self._stats.get(self._key(question_type, difficulty), {}))
+
+        tokens_per_question = stats.get('tokens_per_question', self.default_tokens_per_question)
+        size = math.floor(self.max_output_tokens * self.safety_margin / tokens_per_question)
+
+        # Back off while replies keep failing to parse or coming back short
+        size = max(math.floor(size * (1 - stats.get('failure_rate', 0.0))), min(size, self.min_backoff_size))
+
+        seconds_per_question = stats.get('seconds_per_question')
+        if self.target_batch_seconds and seconds_per_question:
+            size = min(size, math.floor(self.target_batch_seconds / seconds_per_question))
+
+        return max(1, min(size, self.max_batch_size))
+
+    def plan(self, num_questions, question_type, difficulty):
+        """Split num_questions into the fewest batches of near-equal size."""
+        if num_questions <= 0:
+            return []
+        size = self.batch_size(question_type, difficulty)
+        num_batches = math.ceil(num_questions / size)
+        base, extra = divmod(num_questions, num_batches)
+        return [base + 1] * extra + [base] * (num_batches - extra)
+
+    def observe(self, question_type, difficulty, requested, returned=0, output_tokens=0, seconds=0.0, failed=False):
+        """Record the outcome of one LLM batch.
+
+        `failed` means the reply could not be parsed or validated; errors
+        that say nothing about batch size, such as timeouts, are not observed.
+        """
+        a = self.smoothing
+        key = self._key(question_type, difficulty)
+        with self._lock:
+            stats = self._stats.setdefault(key, {'failure_rate': 0.0, 'batches': 0, 'failures': 0})
+            stats['batches'] += 1
+
+            short = failed or returned < requested
+            stats['failure_rate'] = (1 - a) * stats['failure_rate'] + (a if short else 0.0)
+            if failed:
+                stats['failures'] += 1
+                return
+
+            if returned:
+                tokens = output_tokens / returned
+                latency = seconds / returned
+                if 'tokens_per_question' in stats:
+                    stats['tokens_per_question'] = (1 - a) * stats['tokens_per_question'] + a * tokens
+                    stats['seconds_per_question'] = (1 - a) * stats['seconds_per_question'] + a * latency
+                else:
+                    stats['tokens_per_question'] = tokens
+                    stats['seconds_per_question'] = latency
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                key: {name: round(value, 3) if isinstance(value, float) else value
+                      for name, value in stats.items()}
+                for key, stats in self._stats.items()
+            }
@@ -0,0 +1,206 @@
+import json
+import math
+import os
+import re
+from collections import Counter
+
+import numpy as np
+
+from Utility.mmap_index import create_generation, publish_generation
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+class BM25Builder:
+    """Collects postings for a BM25 index while chunks are ingested.
+
+    Document ids are insertion positions and must match the row order of
+    the vector index saved beside it; texts are not kept, the reader gets
+    them from that vector index.
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_lengths = []
+        self.postings = {}  # term -> [doc_id, term_frequency, doc_id, term_frequency, ...]
+
+    def add_documents(self, documents):
+        for doc in documents:
+            doc_id = len(self.doc_lengths)
+            tokens = tokenize(doc.page_content)
+            self.doc_lengths.append(len(tokens))
+            for term, frequency in Counter(tokens).items():
+                self.postings.setdefault(term, []).extend((doc_id, frequency))
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    @classmethod
+    def from_index(cls, index):
+        """Reopen a saved index for appending, without re-tokenizing its documents."""
+        builder = cls(k1=index.k1, b=index.b)
+        builder.doc_lengths = index.lengths.tolist()
+        for term_id in range(index.num_terms):
+            builder.postings[index.term(term_id)] = index.postings(term_id).ravel().tolist()
+        return builder
+
+    def save(self, directory):
+        """Write a new generation of the mmap layout described on BM25Index."""
+        os.makedirs(directory, exist_ok=True)
+        generation = create_generation(directory, prefix='bm25')
+        path = os.path.join(directory, generation)
+
+        terms = sorted(self.postings)
+        encoded = [term.encode('utf-8') for term in terms]
+        np.cumsum([0] + [len(term) for term in encoded], dtype=np.uint64).tofile(os.path.join(path, 'term_offsets.u64'))
+        with open(os.path.join(path, 'terms.bin'), 'wb') as f:
+            f.write(b''.join(encoded))
+
+        pairs = [len(self.postings[term]) // 2 for term in terms]
+        np.cumsum([0] + pairs, dtype=np.uint64).tofile(os.path.join(path, 'posting_offsets.u64'))
+        with open(os.path.join(path, 'postings.u32'), 'wb') as f:
+            for term in terms:
+                np.asarray(self.postings[term], dtype=np.uint32).tofile(f)
+        np.asarray(self.doc_lengths, dtype=np.uint32).tofile(os.path.join(path, 'lengths.u32'))
+
+        publish_generation(directory, BM25Index.FILENAME, {
+            'format': BM25Index.FORMAT,
+            'generation': generation,
+            'k1': self.k1,
+            'b': self.b,
+            'count': len(self.doc_lengths),
+            'terms': len(terms),
+            'total_length': int(sum(self.doc_lengths))
+        }, prefix='bm25')
+
+
+class BM25Index:
+    """Read-only Okapi BM25 index over memory-mapped postings.
+
+    Layout, in the generation directory named by bm25.json:
+        terms.bin            sorted vocabulary, UTF-8, concatenated
+        term_offsets.u64     terms + 1 byte offsets into terms.bin
+        postings.u32         (doc_id, term_frequency) pairs grouped by term
+        posting_offsets.u64  terms + 1 pair offsets into postings.u32
+        lengths.u32          token count of every document
+
+    Terms are found by binary search over the mapped vocabulary, so the
+    heap holds nothing per term or document. Chunk texts are read from the
+    vector index through `document`, which `attach` sets.
+    """
+
+    FILENAME = 'bm25.json'
+    FORMAT = 'bm25-v2'
+
+    def __init__(self, directory, meta, document=None):
+        self.directory = directory
+        self.meta = meta
+        self.path = os.path.join(directory, meta['generation'])
+        self.k1 = meta['k1']
+        self.b = meta['b']
+        self.count = meta['count']
+        self.num_terms = meta['terms']
+        self.average_length = (meta['total_length'] / self.count or 1.0) if self.count else 1.0
+        self.term_offsets = self._map('term_offsets.u64', np.uint64, (self.num_terms + 1,))
+        self.terms = self._map('terms.bin', np.uint8, (int(self.term_offsets[-1]),))
+        self.posting_offsets = self._map('posting_offsets.u64', np.uint64, (self.num_terms + 1,))
+        self.pairs = self._map('postings.u32', np.uint32, (int(self.posting_offsets[-1]), 2))
+        self.lengths = self._map('lengths.u32', np.uint32, (self.count,))
+        self.document = document
+        # Postings and vocabulary live in the page cache
+        self.memory_bytes = 4096
+
+    def _map(self, name, dtype, shape):
+        if not shape[0]:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode='r', shape=shape)
+
+    def attach(self, document):
+        """Set the callable that returns the Document for a row of the vector index."""
+        self.document = document
+        return self
+
+    def __len__(self):
+        return self.count
+
+    def term(self, term_id):
+        start, end = int(self.term_offsets[term_id]), int(self.term_offsets[term_id + 1])
+        return self.terms[start:end].tobytes().decode('utf-8')
+
+    def term_id(self, term):
+        """Position of a term in the sorted vocabulary, or None."""
+        target = term.encode('utf-8')
+        low, high = 0, self.num_terms
+        while low < high:
+            middle = (low + high) // 2
+            start, end = int(self.term_offsets[middle]), int(self.term_offsets[middle + 1])
+            current = self.terms[start:end].tobytes()
+            if current == target:
+                return middle
+            if current < target:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def postings(self, term_id):
+        return self.pairs[int(self.posting_offsets[term_id]):int(self.posting_offsets[term_id + 1])]
+
+    def search(self, query, k=4):
+        """Return up to k (Document, score) pairs, best first."""
+        if not self.count:
+            return []
+        scores = {}
+        for term in set(tokenize(query)):
+            term_id = self.term_id(term)
+            if term_id is None:
+                continue
+            postings = np.asarray(self.postings(term_id), dtype=np.float64)
+            doc_ids, frequencies = postings[:, 0].astype(np.int64), postings[:, 1]
+            idf = math.log(1 + (self.count - len(doc_ids) + 0.5) / (len(doc_ids) + 0.5))
+            norm = self.k1 * (1 - self.b + self.b * self.lengths[doc_ids] / self.average_length)
+            for doc_id, score in zip(doc_ids.tolist(), (idf * frequencies * (self.k1 + 1) / (frequencies + norm)).tolist()):
+                scores[doc_id] = scores.get(doc_id, 0.0) + score
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.document(doc_id), score) for doc_id, score in best]
+
+    def contains_phrase(self, phrase):
+        """True when the phrase appears literally (case and spacing insensitive) in some chunk."""
+        terms = tokenize(phrase)
+        if not terms:
+            return False
+        candidates = None
+        for term in set(terms):
+            term_id = self.term_id(term)
+            if term_id is None:
+                return False
+            doc_ids = set(self.postings(term_id)[:, 0].tolist())
+            candidates = doc_ids if candidates is None else candidates & doc_ids
+            if not candidates:
+                return False
+        needle = ' '.join(terms)
+        return any(needle in ' '.join(tokenize(self.document(doc_id).page_content)) for doc_id in sorted(candidates))
+
+    @classmethod
+    def read_meta(cls, directory):
+        path = os.path.join(directory, cls.FILENAME)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        # bm25.json files from before the mmap layout held the whole index; rebuild those
+        return meta if meta.get('format') == cls.FORMAT else None
+
+    @classmethod
+    def exists(cls, directory):
+        return cls.read_meta(directory) is not None
+
+    @classmethod
+    def load(cls, directory, document=None):
+        meta = cls.read_meta(directory)
+        return cls(directory, meta, document) if meta else None
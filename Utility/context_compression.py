@@ -0,0 +1,61 @@
+import re
+
+import numpy as np
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+SENTENCE_RE = re.compile(r'(?<=[.!?])\s+|\n+')
+
+
+def split_sentences(text):
+    return [sentence.strip() for sentence in SENTENCE_RE.split(text) if sentence and sentence.strip()]
+
+
+def compress_context(query, docs, max_tokens, count_tokens, redundancy=0.5, min_words=4):
+    """Fill the token budget with the candidate sentences most relevant to the query.
+
+    Sentences from all candidate chunks are scored by TF-IDF cosine
+    similarity to the query, less `redundancy` times their similarity to
+    sentences already chosen. They are picked greedily while they fit and
+    then joined in their original order.
+    """
+    sentences = []
+    for doc in docs:
+        for sentence in split_sentences(doc.page_content):
+            if len(sentence.split()) >= min_words and sentence not in sentences:
+                sentences.append(sentence)
+    if not sentences:
+        return ""
+
+    vectorizer = TfidfVectorizer(stop_words='english', sublinear_tf=True)
+    try:
+        matrix = vectorizer.fit_transform(sentences + [query])
+    except ValueError:
+        # Nothing but stop words; keep the retrieval order
+        matrix = None
+    if matrix is None:
+        relevance = np.linspace(1.0, 0.5, len(sentences))
+        similarity = np.zeros((len(sentences), len(sentences)))
+    else:
+        vectors = matrix[:-1]
+        relevance = (vectors @ matrix[-1].T).toarray().ravel()
+        # Retrieval rank breaks ties, so earlier chunks win when nothing matches the query
+        relevance += np.linspace(1e-3, 0, len(sentences))
+        similarity = (vectors @ vectors.T).toarray()
+
+    tokens = [count_tokens(sentence) for sentence in sentences]
+    chosen = []
+    used = 0
+    penalty = np.zeros(len(sentences))
+    available = np.ones(len(sentences), dtype=bool)
+    while available.any():
+        scores = np.where(available, relevance - redundancy * penalty, -np.inf)
+        best = int(np.argmax(scores))
+        available[best] = False
+        separator = 1 if chosen else 0
+        if used + separator + tokens[best] > max_tokens:
+            continue
+        chosen.append(best)
+        used += separator + tokens[best]
+        penalty = np.maximum(penalty, similarity[best])
+
+    return "\n".join(sentences[i] for i in sorted(chosen))
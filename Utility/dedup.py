@@ -0,0 +1,97 @@
+import re
+import zlib
+
+import numpy as np
+
+WORD_RE = re.compile(r'\w+')
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+class ChunkDeduplicator:
+    """Drops near-duplicate chunks using MinHash signatures over word shingles.
+
+    Signatures are bucketed with LSH banding, so each new chunk is only
+    compared with the few earlier chunks that share a band. A chunk whose
+    estimated Jaccard similarity to a kept chunk reaches `threshold` is
+    dropped; with `merge_pages` its page number is added to the kept
+    chunk's `pages` metadata, so only then are kept chunks held. State
+    carries across calls to `filter`, so one instance can dedup a document
+    fed in batches.
+    """
+
+    def __init__(self, threshold=0.8, num_perm=64, bands=16, shingle_size=5, merge_pages=True, seed=1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.merge_pages = merge_pages
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, MERSENNE_PRIME, size=num_perm, dtype=np.int64)
+        self.b = rng.integers(0, MERSENNE_PRIME, size=num_perm, dtype=np.int64)
+        self.buckets = {}  # (band, band signature) -> [kept index, ...]
+        self.signatures = []
+        self.kept = []
+        self.removed = 0
+
+    def shingles(self, text):
+        words = WORD_RE.findall(text.lower())
+        if len(words) <= self.shingle_size:
+            return {' '.join(words)}
+        return {' '.join(words[i:i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)}
+
+    def signature(self, text):
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode('utf-8')) for shingle in self.shingles(text)), dtype=np.int64)
+        return ((np.outer(hashes, self.a) + self.b) % MERSENNE_PRIME).min(axis=0)
+
+    def band_keys(self, signature):
+        return [(band, signature[band * self.rows:(band + 1) * self.rows].tobytes()) for band in range(self.bands)]
+
+    def find_duplicate(self, signature, keys):
+        seen = set()
+        for key in keys:
+            for index in self.buckets.get(key, ()):
+                if index in seen:
+                    continue
+                seen.add(index)
+                if np.mean(self.signatures[index] == signature) >= self.threshold:
+                    return index
+        return None
+
+    def filter(self, docs):
+        """Return the docs that are not near-duplicates of any doc seen so far."""
+        unique = []
+        for doc in docs:
+            if not doc.page_content.strip():
+                # Blank chunks are dropped, but they are not duplicates
+                continue
+            signature = self.signature(doc.page_content)
+            keys = self.band_keys(signature)
+            duplicate = self.find_duplicate(signature, keys)
+            if duplicate is not None:
+                self.removed += 1
+                if self.merge_pages:
+                    self.merge(self.kept[duplicate], doc)
+                continue
+
+            index = len(self.signatures)
+            if self.merge_pages:
+                # Kept docs are only needed to merge later pages into
+                self.kept.append(doc)
+            self.signatures.append(signature)
+            for key in keys:
+                self.buckets.setdefault(key, []).append(index)
+            unique.append(doc)
+        return unique
+
+    @staticmethod
+    def merge(kept, duplicate):
+        page = duplicate.metadata.get('page')
+        if page is None:
+            return
+        pages = kept.metadata.setdefault('pages', [kept.metadata.get('page')])
+        if page not in pages:
+            pages.append(page)
@@ -0,0 +1,224 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to the in-process lock only
+    fcntl = None
+
+
+class EmbeddingStore:
+    """Append-only float32 matrix on disk plus an index of key -> row.
+
+    index.json is a snapshot naming the current generation; rows added
+    since are appended to that generation's journal instead of rewriting
+    the snapshot. When the matrix grows past `max_bytes` the least
+    recently used rows are copied into the next generation's vectors file
+    and the snapshot is replaced, so a reader never sees an index and a
+    matrix from different generations. Readers take a shared file lock,
+    writers an exclusive one.
+    """
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(directory, 'index.json')
+        self.lock_path = os.path.join(directory, '.lock')
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._index_version = None
+        self._journal_offset = 0
+        self.generation = None
+        self.dim = None
+        self.rows = {}  # key -> [row, last_used]
+        self.touched = {}  # key -> last_used, written with the next put
+        self.journal_entries = 0
+
+    def _path(self, name, extension):
+        # Caches written before generations have a single vectors.f32
+        suffix = '' if self.generation is None else f"-{self.generation}"
+        return os.path.join(self.directory, f"{name}{suffix}.{extension}")
+
+    @property
+    def vectors_path(self):
+        return self._path('vectors', 'f32')
+
+    @property
+    def journal_path(self):
+        return self._path('journal', 'jsonl')
+
+    def _refresh(self):
+        """Catch up with the snapshot and journal other processes may have written."""
+        if not os.path.exists(self.index_path):
+            return
+        stat = os.stat(self.index_path)
+        version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if version != self._index_version:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                index = json.load(f)
+            self.dim = index.get('dim')
+            self.generation = index.get('generation')
+            self.rows = index.get('rows', {})
+            self._index_version = version
+            self._journal_offset = 0
+            self.journal_entries = 0
+        if not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path, 'rb') as f:
+            f.seek(self._journal_offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # written by a process that died mid-append
+                self._journal_offset += len(line)
+                self.journal_entries += 1
+                key, row, last_used = json.loads(line)
+                if row is None:
+                    if key in self.rows:
+                        self.rows[key][1] = last_used
+                else:
+                    self.rows[key] = [row, last_used]
+
+    def _save_index(self):
+        tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'dim': self.dim, 'generation': self.generation, 'rows': self.rows}, f)
+        os.replace(tmp_path, self.index_path)
+        stat = os.stat(self.index_path)
+        self._index_version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        self._journal_offset = 0
+        self.journal_entries = 0
+
+    def _append_journal(self, entries):
+        lines = ''.join(json.dumps(entry) + '\n' for entry in entries).encode('utf-8')
+        with open(self.journal_path, 'ab') as f:
+            f.write(lines)
+        self._journal_offset += len(lines)
+        self.journal_entries += len(entries)
+
+    def _file_lock(self, shared=False):
+        handle = open(self.lock_path, 'a')
+        if fcntl:
+            fcntl.flock(handle, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        return handle
+
+    def _matrix(self):
+        count = os.path.getsize(self.vectors_path) // (self.dim * 4)
+        return np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(count, self.dim))
+
+    def get_many(self, keys):
+        """Return {key: vector} for the keys present in the store."""
+        with self._lock:
+            handle = self._file_lock(shared=True)
+            try:
+                self._refresh()
+                hits = [key for key in keys if key in self.rows]
+                if not hits:
+                    return {}
+                now = time.time()
+                for key in hits:
+                    self.rows[key][1] = now
+                    self.touched[key] = now
+                matrix = self._matrix()
+                vectors = np.asarray(matrix[[self.rows[key][0] for key in hits]])
+                return {key: vector.tolist() for key, vector in zip(hits, vectors)}
+            finally:
+                handle.close()
+
+    def put_many(self, keys, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            handle = self._file_lock()
+            try:
+                self._refresh()
+                if self.dim is None:
+                    self.dim = int(vectors.shape[1])
+                    self.generation = 1
+                    self._save_index()
+                elif self.dim != vectors.shape[1]:
+                    raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match cache ({self.dim})")
+
+                start = os.path.getsize(self.vectors_path) // (self.dim * 4) if os.path.exists(self.vectors_path) else 0
+                with open(self.vectors_path, 'ab') as f:
+                    f.write(vectors.tobytes())
+                now = time.time()
+                entries = [[key, None, last_used] for key, last_used in self.touched.items() if key in self.rows]
+                self.touched = {}
+                for offset, key in enumerate(keys):
+                    self.rows[key] = [start + offset, now]
+                    entries.append([key, start + offset, now])
+
+                if (start + len(keys)) * self.dim * 4 > self.max_bytes:
+                    self._evict()
+                elif self.journal_entries + len(entries) > max(1024, len(self.rows)):
+                    # Fold a long journal back into the snapshot; readers reload it before the journal
+                    self._save_index()
+                    if os.path.exists(self.journal_path):
+                        os.remove(self.journal_path)
+                else:
+                    self._append_journal(entries)
+            finally:
+                handle.close()
+
+    def _evict(self):
+        """Copy the most recently used rows that fit in 80% of max_bytes into the next generation."""
+        keep_count = int(self.max_bytes * 0.8) // (self.dim * 4)
+        ordered = sorted(self.rows.items(), key=lambda item: item[1][1], reverse=True)[:keep_count]
+        matrix = self._matrix()
+        kept = np.asarray(matrix[[row for _, (row, _) in ordered]]) if ordered else np.empty((0, self.dim), np.float32)
+        del matrix
+
+        old_paths = [self.vectors_path, self.journal_path]
+        self.generation = (self.generation or 0) + 1
+        kept.astype(np.float32).tofile(self.vectors_path)
+        evicted = len(self.rows) - len(ordered)
+        self.rows = {key: [new_row, last_used] for new_row, (key, (_, last_used)) in enumerate(ordered)}
+        # The snapshot switches generations in one rename; the old files go after
+        self._save_index()
+        for path in old_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        logging.info(f"Embedding cache evicted {evicted} vectors")
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that only sends texts missing from the disk cache to the backend."""
+
+    def __init__(self, embeddings, cache_dir='embedding_cache', model_name=None, max_bytes=512 * 1024 * 1024):
+        self.embeddings = embeddings
+        self.model_name = model_name or getattr(embeddings, 'model', type(embeddings).__name__)
+        safe_name = re.sub(r'[^A-Za-z0-9_.-]', '_', self.model_name)
+        self.store = EmbeddingStore(os.path.join(cache_dir, safe_name), max_bytes=max_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode('utf-8')).hexdigest()
+
+    def embed_documents(self, texts):
+        keys = [self.key(text) for text in texts]
+        found = self.store.get_many(keys)
+
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            self.store.put_many(list(missing.keys()), vectors)
+            found.update(zip(missing.keys(), vectors))
+        logging.info(f"Embedding cache: {len(texts) - len(missing)} hits, {len(missing)} misses")
+        return [list(found[key]) for key in keys]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
@@ -0,0 +1,58 @@
+import os
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from sklearn.feature_extraction.text import HashingVectorizer
+
+
+class HashingEmbeddings(Embeddings):
+    """Offline embeddings: L2-normalised hashed word and bigram counts.
+
+    Stateless, so documents and queries embedded by different processes
+    always agree, and nothing leaves the machine.
+    """
+
+    is_local = True
+
+    def __init__(self, n_features=1024, ngram_range=(1, 2)):
+        self.vectorizer = HashingVectorizer(
+            n_features=n_features,
+            ngram_range=ngram_range,
+            alternate_sign=False,
+            stop_words='english',
+            norm='l2'
+        )
+        self.model = f"hashing-{n_features}-{ngram_range[0]}{ngram_range[1]}"
+
+    def embed_documents(self, texts):
+        return self.vectorizer.transform(texts).toarray().astype(np.float32).tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def _openai_embeddings():
+    from langchain_openai import OpenAIEmbeddings
+    return OpenAIEmbeddings()
+
+
+def _hashing_embeddings():
+    return HashingEmbeddings(n_features=int(os.getenv('HASHING_EMBEDDING_DIM', 1024)))
+
+
+# Backend name -> factory; selected per deployment with EMBEDDING_BACKEND
+EMBEDDING_BACKENDS = {
+    'openai': _openai_embeddings,
+    'hashing': _hashing_embeddings
+}
+
+
+def register_embedding_backend(name, factory):
+    EMBEDDING_BACKENDS[name] = factory
+
+
+def get_embeddings(backend=None):
+    backend = backend or os.getenv('EMBEDDING_BACKEND', 'openai')
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend: {backend}")
+    return EMBEDDING_BACKENDS[backend]()
@@ -0,0 +1,50 @@
+import logging
+import os
+import re
+
+# Content-addressed cache files are named by the sha256 of the source PDF
+CONTENT_FILE_RE = re.compile(r'^([0-9a-f]{64})\.[a-z]+$')
+
+
+def touch(path):
+    """Mark a cache file as just used; pruning removes the least recently touched first."""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def prune_directory(directory, max_bytes, keep_hashes=()):
+    """Delete the least recently used content-addressed files until the directory fits in max_bytes.
+
+    Files whose hash is in `keep_hashes` are never removed, nor is anything
+    not named like a content hash (upload spools, temp files). Returns the
+    number of bytes freed.
+    """
+    if not os.path.isdir(directory):
+        return 0
+    files = []
+    total = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue  # removed meanwhile
+        total += stat.st_size
+        match = CONTENT_FILE_RE.match(name)
+        if match and match.group(1) not in keep_hashes:
+            files.append((stat.st_mtime, stat.st_size, path))
+
+    freed = 0
+    for _, size, path in sorted(files):
+        if total - freed <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            freed += size
+        except OSError as e:
+            logging.warning(f"Could not prune {path}: {e}")
+    if freed:
+        logging.info(f"Pruned {freed} bytes from {directory}")
+    return freed
@@ -0,0 +1,106 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+
+class IndexRegistry:
+    """In-process LRU of loaded vector indexes, bounded by their total size in bytes.
+
+    Each entry remembers the on-disk version (file sizes and mtimes) it was
+    loaded from; an entry whose directory has changed since is reloaded.
+    """
+
+    def __init__(self, loader, max_bytes=1024 * 1024 * 1024):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # path -> {'index', 'version', 'bytes'}
+        self._lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'invalidations': 0, 'evictions': 0, 'registrations': 0}
+
+    @staticmethod
+    def disk_version(path):
+        if not os.path.isdir(path):
+            return None
+        version = []
+        for name in sorted(os.listdir(path)):
+            try:
+                stat = os.stat(os.path.join(path, name))
+            except FileNotFoundError:
+                continue  # an old generation or temp file removed by a concurrent save
+            version.append(f"{name}:{stat.st_size}:{stat.st_mtime_ns}")
+        return '|'.join(version)
+
+    @staticmethod
+    def estimate_bytes(path):
+        """Loaded size is close to the size of the saved files for flat indexes."""
+        if not os.path.isdir(path):
+            return 0
+        total = 0
+        for name in os.listdir(path):
+            try:
+                total += os.path.getsize(os.path.join(path, name))
+            except FileNotFoundError:
+                continue
+        return total
+
+    def get(self, path):
+        path = os.path.normpath(path)
+        version = self.disk_version(path)
+        if version is None:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry and entry['version'] == version:
+                self._entries.move_to_end(path)
+                self.stats['hits'] += 1
+                return entry['index']
+            if entry:
+                self.stats['invalidations'] += 1
+            self.stats['misses'] += 1
+
+        index = self.loader(path)
+        self._store(path, index, version)
+        return index
+
+    def put(self, path, index):
+        """Register an index that was just built and saved, skipping the reload."""
+        path = os.path.normpath(path)
+        self._store(path, index, self.disk_version(path))
+        with self._lock:
+            self.stats['registrations'] += 1
+
+    def invalidate(self, path):
+        with self._lock:
+            self._entries.pop(os.path.normpath(path), None)
+
+    def _store(self, path, index, version):
+        # Memory-mapped indexes report their own (small) heap footprint
+        size = getattr(index, 'memory_bytes', None)
+        if size is None:
+            size = self.estimate_bytes(path)
+        elif getattr(index, 'bm25', None) is not None:
+            # A BM25 index loaded beside it is held by the same entry
+            size += index.bm25.memory_bytes
+        with self._lock:
+            self._entries[path] = {'index': index, 'version': version, 'bytes': size}
+            self._entries.move_to_end(path)
+            # Always keep the newest entry even if it alone exceeds the budget
+            while len(self._entries) > 1 and self._total_bytes() > self.max_bytes:
+                evicted, _ = self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+                logging.info(f"Index registry evicted {evicted}")
+
+    def _total_bytes(self):
+        return sum(entry['bytes'] for entry in self._entries.values())
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._total_bytes()
+            stats['max_bytes'] = self.max_bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+        return stats
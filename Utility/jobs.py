@@ -0,0 +1,229 @@
+import logging
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+
+
+class JobContext:
+    """Handle passed to a job handler for reading its payload and saving progress."""
+
+    def __init__(self, queue, doc):
+        self.queue = queue
+        self.job_id = doc['_id']
+        self.payload = doc.get('payload', {})
+        self.state = doc.get('state', {})
+        self.results = doc.get('results', {})
+
+    def set_state(self, key, value):
+        """Persist a piece of handler state so a resumed job can reuse it."""
+        self.state[key] = value
+        self.queue._update(self.job_id, {'$set': {f'state.{key}': value}})
+        return value
+
+    def set_total(self, total):
+        self.queue._update(self.job_id, {'$set': {'progress.total': total}})
+
+    def update_progress(self, **fields):
+        self.queue._update(self.job_id, {'$set': {f'progress.{k}': v for k, v in fields.items()}})
+
+    def save_result(self, key, value):
+        """Store one finished unit of work and count it as done."""
+        self.results[key] = value
+        self.queue._update(self.job_id, {
+            '$set': {f'results.{key}': value},
+            '$inc': {'progress.done': 1}
+        })
+
+
+class JobQueue:
+    """Bounded worker pool whose job state lives in a MongoDB collection.
+
+    Finished units of work are written to the job document as they complete,
+    so a job picked up again after a restart only redoes what was unfinished.
+
+    While a job runs, its worker stamps `heartbeat_at` every
+    `heartbeat_interval`. Every queue periodically requeues running jobs
+    whose heartbeat is older than `stale_after`, so a job orphaned by a
+    crashed process is picked up again by whichever process is alive.
+    """
+
+    def __init__(self, collection, max_workers=2, stale_after=timedelta(minutes=2),
+                 heartbeat_interval=timedelta(seconds=30)):
+        self.collection = collection
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.handlers = {}
+        self.stale_after = stale_after
+        self.heartbeat_interval = heartbeat_interval
+        self.hostname = socket.gethostname()
+        self.worker_id = f"{self.hostname}:{os.getpid()}"
+        self._monitor = None
+        self._stopped = threading.Event()
+        try:
+            # At most one queued or running job per claim; finished jobs drop theirs
+            self.collection.create_index('claim', unique=True, sparse=True)
+        except Exception as e:
+            logging.warning(f"Job claim index creation failed: {e}")
+
+    def register(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def submit(self, kind, payload, total=0, claim=None, job_id=None):
+        """Queue a job and return its id.
+
+        With `claim`, the insert fails with pymongo's DuplicateKeyError while
+        another queued or running job holds the same claim.
+        """
+        now = datetime.utcnow()
+        doc = {'_id': job_id} if job_id else {}
+        if claim:
+            doc['claim'] = claim
+        job_id = self.collection.insert_one({
+            **doc,
+            'kind': kind,
+            'status': 'queued',
+            'payload': payload,
+            'state': {},
+            'results': {},
+            'progress': {'done': 0, 'total': total},
+            'result': None,
+            'error': None,
+            'created_at': now,
+            'updated_at': now
+        }).inserted_id
+        self.executor.submit(self._run, job_id)
+        return str(job_id)
+
+    def get(self, job_id):
+        try:
+            return self.collection.find_one({'_id': ObjectId(job_id)})
+        except Exception:
+            return None
+
+    def claimed_by(self, claim):
+        return self.collection.find_one({'claim': claim})
+
+    def is_live(self, doc):
+        """True while a job is queued, or running with a fresh heartbeat."""
+        if not doc or doc.get('status') not in ('queued', 'running'):
+            return False
+        if doc['status'] == 'queued':
+            return True
+        heartbeat = doc.get('heartbeat_at') or doc.get('updated_at')
+        return bool(heartbeat) and heartbeat >= datetime.utcnow() - self.stale_after
+
+    def supersede(self, job_id, reason):
+        """Fail a job that has not finished and release its claim; returns True if it did."""
+        doc = self.collection.find_one_and_update(
+            {'_id': job_id, 'status': {'$in': ['queued', 'running']}},
+            {'$set': {'status': 'failed', 'error': reason, 'updated_at': datetime.utcnow()},
+             '$unset': {'claim': ''}}
+        )
+        if doc:
+            logging.warning(f"Job {job_id} superseded: {reason}")
+        return doc is not None
+
+    def resume(self):
+        """Requeue jobs of the registered kinds left unfinished by a previous process.
+
+        Running jobs of dead processes on this host are requeued at once;
+        others when their heartbeat goes stale. Also starts the heartbeat
+        and stale-job sweep thread.
+        """
+        kinds = {'$in': list(self.handlers)}
+        for doc in self.collection.find({'status': 'running', 'kind': kinds}, {'worker': 1}):
+            if self._is_dead_local_worker(doc.get('worker')):
+                self._requeue(doc['_id'], {'worker': doc.get('worker')})
+        self.sweep()
+        resumed = 0
+        for doc in self.collection.find({'status': 'queued', 'kind': kinds}, {'_id': 1}):
+            self.executor.submit(self._run, doc['_id'])
+            resumed += 1
+        if resumed:
+            logging.info(f"Resumed {resumed} queued jobs")
+        self._start_monitor()
+        return resumed
+
+    def _is_dead_local_worker(self, worker):
+        host, _, pid = str(worker or '').rpartition(':')
+        if host != self.hostname or not pid.isdigit():
+            return False
+        if int(pid) == os.getpid():
+            # Our own pid from before a restart (pid 1 in a container); nothing runs here yet
+            return True
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except OSError:
+            pass  # exists but belongs to someone else
+        return False
+
+    def _requeue(self, job_id, condition):
+        """Put a running job back in the queue if it still matches `condition`; returns True if it did."""
+        doc = self.collection.find_one_and_update(
+            {'_id': job_id, 'status': 'running', **condition},
+            {'$set': {'status': 'queued', 'updated_at': datetime.utcnow()}, '$unset': {'worker': ''}}
+        )
+        if doc:
+            logging.warning(f"Requeued job {job_id} orphaned by {doc.get('worker')}")
+        return doc is not None
+
+    def sweep(self):
+        """Requeue and run running jobs whose heartbeat is older than stale_after."""
+        cutoff = datetime.utcnow() - self.stale_after
+        stale = {'$or': [{'heartbeat_at': {'$lt': cutoff}},
+                         {'heartbeat_at': {'$exists': False}, 'updated_at': {'$lt': cutoff}}]}
+        requeued = 0
+        for doc in self.collection.find({'status': 'running', 'kind': {'$in': list(self.handlers)}, **stale}, {'_id': 1}):
+            if self._requeue(doc['_id'], stale):
+                self.executor.submit(self._run, doc['_id'])
+                requeued += 1
+        return requeued
+
+    def heartbeat(self):
+        self.collection.update_many(
+            {'status': 'running', 'worker': self.worker_id, 'kind': {'$in': list(self.handlers)}},
+            {'$set': {'heartbeat_at': datetime.utcnow()}}
+        )
+
+    def _start_monitor(self):
+        if self._monitor is None:
+            self._monitor = threading.Thread(target=self._monitor_loop, name='job-monitor', daemon=True)
+            self._monitor.start()
+
+    def _monitor_loop(self):
+        while not self._stopped.wait(self.heartbeat_interval.total_seconds()):
+            try:
+                self.heartbeat()
+                self.sweep()
+            except Exception as e:
+                logging.warning(f"Job heartbeat failed: {e}")
+
+    def _update(self, job_id, update):
+        update.setdefault('$set', {})['updated_at'] = datetime.utcnow()
+        self.collection.update_one({'_id': job_id}, update)
+
+    def _run(self, job_id):
+        # Claim the job atomically so two workers never run it at once
+        doc = self.collection.find_one_and_update(
+            {'_id': job_id, 'status': 'queued'},
+            {'$set': {'status': 'running', 'worker': self.worker_id,
+                      'updated_at': datetime.utcnow(), 'heartbeat_at': datetime.utcnow()}},
+            return_document=ReturnDocument.AFTER
+        )
+        if not doc:
+            return
+
+        try:
+            handler = self.handlers[doc['kind']]
+            result = handler(JobContext(self, doc))
+            self._update(job_id, {'$set': {'status': 'completed', 'result': result}, '$unset': {'claim': ''}})
+            logging.info(f"Job {job_id} completed")
+        except Exception as e:
+            logging.error(f"Job {job_id} failed: {e}")
+            self._update(job_id, {'$set': {'status': 'failed', 'error': str(e)}, '$unset': {'claim': ''}})
@@ -0,0 +1,198 @@
+import json
+import mmap
+import os
+import shutil
+import time
+
+import numpy as np
+from langchain_core.documents import Document
+
+
+def create_generation(directory, prefix='gen'):
+    """Make an empty subdirectory to write the next version of an index into."""
+    generation = f"{prefix}-{time.time_ns():016x}-{os.getpid()}"
+    os.makedirs(os.path.join(directory, generation))
+    return generation
+
+
+def publish_generation(directory, meta_name, meta, prefix='gen', keep=2):
+    """Point `meta_name` at a fully written generation, then prune old ones.
+
+    The metadata file is swapped in with an atomic rename, so a reader sees
+    either the old generation or the new one, never a mix. Files of a
+    published generation are never rewritten; old generations are only
+    unlinked, which is safe while another process still has them mapped.
+    The previous `keep - 1` generations stay for readers that have read
+    the old metadata but not yet opened its files.
+    """
+    write_json_atomic(os.path.join(directory, meta_name), meta)
+    generations = sorted(name for name in os.listdir(directory)
+                         if name.startswith(f"{prefix}-") and os.path.isdir(os.path.join(directory, name)))
+    older = [name for name in generations if name != meta.get('generation')]
+    for name in older[:max(0, len(older) - (keep - 1))]:
+        shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+def write_json_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.{time.time_ns()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class MmapVectorIndex:
+    """Read-only flat vector index stored without pickle and opened with mmap.
+
+    Directory layout:
+        meta.json        format, dim, count, dtype, embedding model and
+                         the generation subdirectory holding the data
+        gen-*/vectors.bin   raw row-major float32/float16 vectors
+        gen-*/norms.f32     squared L2 norm of every vector
+        gen-*/chunks.jsonl  one {"page_content", "metadata"} object per line
+        gen-*/offsets.u64   count + 1 byte offsets into chunks.jsonl
+
+    All files are mapped rather than read, so workers opening the same
+    index share one copy through the OS page cache. Rewriting an index
+    writes a new generation and swaps meta.json, so mapped files are never
+    truncated under a reader.
+    """
+
+    FORMAT = 'mmap-v1'
+    FILES = ['vectors.bin', 'norms.f32', 'chunks.jsonl', 'offsets.u64']
+    # Files of the layout before generations, which sat next to meta.json
+    LEGACY_FILES = FILES + ['quantized.faiss', 'quantized.json', 'report.json']
+    BLOCK_ROWS = 65536
+
+    def __init__(self, directory, embeddings=None):
+        self.directory = directory
+        self.embeddings = embeddings
+        with open(os.path.join(directory, 'meta.json'), 'r', encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if self.meta.get('format') != self.FORMAT:
+            raise ValueError(f"Unsupported index format: {self.meta.get('format')}")
+
+        # Indexes written before generations keep their files next to meta.json
+        self.path = os.path.join(directory, self.meta.get('generation', ''))
+        self.dim = self.meta['dim']
+        self.count = self.meta['count']
+        self.vectors = self._map('vectors.bin', self.meta['dtype'], (self.count, self.dim))
+        self.norms = self._map('norms.f32', np.float32, (self.count,))
+        self.offsets = self._map('offsets.u64', np.uint64, (self.count + 1,))
+        with open(os.path.join(self.path, 'chunks.jsonl'), 'rb') as f:
+            self.chunks = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.count else b''
+        # Everything is page cache backed; only bookkeeping lives on the heap
+        self.memory_bytes = 4096
+
+    def _map(self, name, dtype, shape):
+        if not shape[0]:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode='r', shape=shape)
+
+    @classmethod
+    def is_mmap_index(cls, directory):
+        return os.path.exists(os.path.join(directory, 'meta.json'))
+
+    @classmethod
+    def write_generation(cls, path, texts, metadatas, vectors, dtype='float32', model=None):
+        """Write the data files into a fresh generation directory; returns its metadata."""
+        vectors = np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+
+        vectors.astype(dtype).tofile(os.path.join(path, 'vectors.bin'))
+        np.einsum('ij,ij->i', vectors, vectors).astype(np.float32).tofile(os.path.join(path, 'norms.f32'))
+
+        offsets = [0]
+        with open(os.path.join(path, 'chunks.jsonl'), 'wb') as f:
+            for text, metadata in zip(texts, metadatas):
+                line = json.dumps({'page_content': text, 'metadata': metadata}, default=str).encode('utf-8') + b'\n'
+                f.write(line)
+                offsets.append(offsets[-1] + len(line))
+        np.asarray(offsets, dtype=np.uint64).tofile(os.path.join(path, 'offsets.u64'))
+
+        return {
+            'format': cls.FORMAT,
+            'generation': os.path.basename(path),
+            'dim': int(vectors.shape[1]) if len(texts) else 0,
+            'count': len(texts),
+            'dtype': np.dtype(dtype).name,
+            'model': model
+        }
+
+    @classmethod
+    def publish(cls, directory, meta):
+        publish_generation(directory, 'meta.json', meta)
+        cls.remove_files(directory, cls.LEGACY_FILES)
+
+    @classmethod
+    def write(cls, directory, texts, metadatas, vectors, dtype='float32', model=None):
+        os.makedirs(directory, exist_ok=True)
+        generation = create_generation(directory)
+        meta = cls.write_generation(os.path.join(directory, generation), texts, metadatas, vectors, dtype, model)
+        cls.publish(directory, meta)
+
+    @staticmethod
+    def remove_files(directory, names):
+        for name in names:
+            path = os.path.join(directory, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    @classmethod
+    def remove(cls, directory):
+        """Drop the index from a directory, e.g. when it is saved in another format."""
+        cls.remove_files(directory, ['meta.json'])
+        for name in os.listdir(directory):
+            if name.startswith('gen-') and os.path.isdir(os.path.join(directory, name)):
+                shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+        cls.remove_files(directory, cls.LEGACY_FILES)
+
+    @classmethod
+    def from_faiss(cls, vectorstore, directory, dtype='float32'):
+        """Convert a LangChain FAISS store into this format."""
+        count = vectorstore.index.ntotal
+        vectors = vectorstore.index.reconstruct_n(0, count) if count else np.zeros((0, vectorstore.index.d))
+        docs = [vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]) for i in range(count)]
+        embeddings = vectorstore.embeddings
+        cls.write(
+            directory,
+            [doc.page_content for doc in docs],
+            [doc.metadata for doc in docs],
+            vectors,
+            dtype=dtype,
+            model=getattr(embeddings, 'model_name', None) or getattr(embeddings, 'model', None)
+        )
+        return cls(directory, embeddings)
+
+    def document(self, i):
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        record = json.loads(self.chunks[start:end])
+        return Document(page_content=record['page_content'], metadata=record['metadata'])
+
+    def exact_search(self, query, k=4):
+        """Row ids and squared L2 distances of the k nearest vectors, nearest first."""
+        query = np.asarray(query, dtype=np.float32)
+        query_norm = float(query @ query)
+        distances = np.empty(self.count, dtype=np.float32)
+        for start in range(0, self.count, self.BLOCK_ROWS):
+            block = np.asarray(self.vectors[start:start + self.BLOCK_ROWS], dtype=np.float32)
+            distances[start:start + len(block)] = self.norms[start:start + len(block)] - 2 * (block @ query) + query_norm
+
+        k = min(k, self.count)
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top])]
+        return top, distances[top]
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, **kwargs):
+        """Exact search returning squared L2 distances, like a flat FAISS index."""
+        if not self.count:
+            return []
+        ids, distances = self.exact_search(embedding, k)
+        return [(self.document(int(i)), float(d)) for i, d in zip(ids, distances)]
+
+    def similarity_search_by_vector(self, embedding, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score_by_vector(embedding, k)]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        return self.similarity_search_with_score_by_vector(self.embeddings.embed_query(query), k)
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
@@ -0,0 +1,99 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from langchain_core.documents import Document
+from pypdf import PdfReader
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _extract_range(pdf_path, start, end):
+    """Worker: extract the text of pages [start, end) of one PDF."""
+    reader = PdfReader(pdf_path)
+    return [reader.pages[i].extract_text() for i in range(start, end)]
+
+
+def _get_pool(max_workers):
+    """The process pool shared by every extraction, started on first use.
+
+    Starting a worker costs seconds, so workers live as long as the process.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn, not fork: the web process has live threads and sockets. Spawned
+            # workers re-import the main module as __mp_main__, so it must be safe to import
+            context = multiprocessing.get_context('spawn')
+            _pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+        return _pool
+
+
+def _discard_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+def iter_pdf_pages(pdf_path, max_workers=None, pages_per_task=8, min_pages=100):
+    """Yield one Document per page, in page order, extracting page ranges in parallel.
+
+    Documents carry the same `source` and `page` metadata as PyPDFLoader.
+    Documents under `min_pages` pages are extracted in this process. At
+    most two ranges per worker are in flight, so memory stays bounded for
+    long documents.
+    """
+    total_pages = len(PdfReader(pdf_path).pages)
+    ranges = [(start, min(start + pages_per_task, total_pages))
+              for start in range(0, total_pages, pages_per_task)]
+    max_workers = max_workers or os.cpu_count() or 1
+
+    def to_documents(start, texts):
+        for offset, text in enumerate(texts):
+            yield Document(page_content=text, metadata={'source': pdf_path, 'page': start + offset})
+
+    def sequential(ranges):
+        for start, end in ranges:
+            yield from to_documents(start, _extract_range(pdf_path, start, end))
+
+    # Small documents extract faster here than the round trips to the workers cost
+    if max_workers == 1 or len(ranges) <= 1 or total_pages < min_pages:
+        yield from sequential(ranges)
+        return
+
+    executor = _get_pool(max_workers)
+    window = 2 * max_workers
+    futures = []
+    next_range = 0
+    try:
+        while next_range < len(ranges) or futures:
+            while next_range < len(ranges) and len(futures) < window:
+                start, end = ranges[next_range]
+                futures.append((start, executor.submit(_extract_range, pdf_path, start, end)))
+                next_range += 1
+            start, future = futures.pop(0)
+            try:
+                texts = future.result()
+            except BrokenProcessPool:
+                # A worker died; the next extraction starts a fresh pool, this one finishes here
+                logging.warning(f"PDF extraction pool broke on '{pdf_path}', continuing sequentially")
+                _discard_pool(executor)
+                futures = []
+                yield from sequential([page_range for page_range in ranges if page_range[0] >= start])
+                return
+            yield from to_documents(start, texts)
+    finally:
+        # Closed early: drop the queued ranges; the pool stays up for the next document
+        for _, future in futures:
+            future.cancel()
+
+
+def extract_pdf_pages(pdf_path, max_workers=None, pages_per_task=8, min_pages=100):
+    return list(iter_pdf_pages(pdf_path, max_workers=max_workers, pages_per_task=pages_per_task,
+                               min_pages=min_pages))
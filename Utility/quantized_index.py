@@ -0,0 +1,189 @@
+import json
+import logging
+import math
+import os
+import time
+
+import faiss
+import numpy as np
+
+from Utility.mmap_index import MmapVectorIndex, create_generation
+
+
+class QuantizedVectorIndex(MmapVectorIndex):
+    """Compressed in-memory FAISS index with exact re-ranking from disk.
+
+    Only the quantized codes (`quantized.faiss` in the index generation, written with
+    faiss.write_index, no pickle) are held in RAM. Each search fetches
+    `rerank_factor * k` candidates from them and re-scores the candidates
+    against the full-precision vectors of the mmap layout, reading just
+    those rows from the page cache.
+
+    Index types:
+        fp16     float16 scalar quantizer, 2x smaller
+        sq8      int8 scalar quantizer, 4x smaller
+        ivf_sq8  inverted lists over int8 codes, 4x smaller and sub-linear search
+        ivfpq    inverted lists with product quantization, 16x smaller by default
+    """
+
+    INDEX_TYPES = ['fp16', 'sq8', 'ivf_sq8', 'ivfpq']
+
+    def __init__(self, directory, embeddings=None):
+        super().__init__(directory, embeddings)
+        with open(os.path.join(self.path, 'quantized.json'), 'r', encoding='utf-8') as f:
+            self.config = json.load(f)
+        self.index = faiss.read_index(os.path.join(self.path, 'quantized.faiss'))
+        if hasattr(self.index, 'nprobe'):
+            self.index.nprobe = self.config.get('nprobe', 1)
+        self.rerank_factor = self.config.get('rerank_factor', 4)
+        self.memory_bytes = os.path.getsize(os.path.join(self.path, 'quantized.faiss'))
+
+    @classmethod
+    def is_quantized_index(cls, directory):
+        if os.path.exists(os.path.join(directory, 'quantized.json')):
+            return True  # layout before generations
+        if not cls.is_mmap_index(directory):
+            return False
+        with open(os.path.join(directory, 'meta.json'), 'r', encoding='utf-8') as f:
+            return bool(json.load(f).get('quantized'))
+
+    @staticmethod
+    def build_faiss_index(vectors, index_type, pq_compression=16):
+        """Train and fill a quantized FAISS index; returns (index, config)."""
+        count, dim = vectors.shape
+        nlist = max(1, min(int(4 * math.sqrt(count)), count // 39))
+        config = {'index_type': index_type}
+
+        if index_type == 'ivfpq':
+            # m sub-quantizers of 8 bits: dim * 4 bytes / m bytes = pq_compression
+            m = max(1, dim * 4 // pq_compression)
+            while dim % m:
+                m -= 1
+            if count < 39 * 256:
+                logging.warning(f"Only {count} vectors; too few to train PQ, using ivf_sq8")
+                return QuantizedVectorIndex.build_faiss_index(vectors, 'ivf_sq8')
+            index = faiss.IndexIVFPQ(faiss.IndexFlatL2(dim), dim, nlist, m, 8)
+            config.update(nlist=nlist, m=m)
+        elif index_type == 'ivf_sq8':
+            index = faiss.IndexIVFScalarQuantizer(
+                faiss.IndexFlatL2(dim), dim, nlist, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2)
+            config.update(nlist=nlist)
+        elif index_type in ('sq8', 'fp16'):
+            qtype = faiss.ScalarQuantizer.QT_8bit if index_type == 'sq8' else faiss.ScalarQuantizer.QT_fp16
+            index = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_L2)
+        else:
+            raise ValueError(f"Unknown index type: {index_type}")
+
+        index.train(vectors)
+        index.add(vectors)
+        if 'nlist' in config:
+            config['nprobe'] = min(nlist, max(1, nlist // 8))
+            index.nprobe = config['nprobe']
+        return index, config
+
+    @classmethod
+    def write_quantized(cls, directory, texts, metadatas, vectors, index_type='ivfpq',
+                        rerank_factor=4, pq_compression=16, model=None):
+        vectors = np.ascontiguousarray(np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1))
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, create_generation(directory))
+        # Full-precision vectors stay on disk for re-ranking
+        meta = cls.write_generation(path, texts, metadatas, vectors, dtype='float32', model=model)
+
+        index, config = cls.build_faiss_index(vectors, index_type, pq_compression)
+        config['rerank_factor'] = rerank_factor
+        faiss.write_index(index, os.path.join(path, 'quantized.faiss'))
+        with open(os.path.join(path, 'quantized.json'), 'w', encoding='utf-8') as f:
+            json.dump(config, f)
+        # Vectors and quantizer become visible together, when meta.json is swapped
+        meta['quantized'] = True
+        cls.publish(directory, meta)
+
+    @classmethod
+    def from_faiss(cls, vectorstore, directory, index_type='ivfpq', rerank_factor=4, pq_compression=16, report=False):
+        """Convert a LangChain FAISS store; `report` also writes the recall/latency report.
+
+        The report runs brute-force searches over the whole corpus, so it is
+        left to offline runs rather than every ingest.
+        """
+        count = vectorstore.index.ntotal
+        vectors = vectorstore.index.reconstruct_n(0, count)
+        docs = [vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]) for i in range(count)]
+        embeddings = vectorstore.embeddings
+        cls.write_quantized(
+            directory,
+            [doc.page_content for doc in docs],
+            [doc.metadata for doc in docs],
+            vectors,
+            index_type=index_type,
+            rerank_factor=rerank_factor,
+            pq_compression=pq_compression,
+            model=getattr(embeddings, 'model_name', None) or getattr(embeddings, 'model', None)
+        )
+        index = cls(directory, embeddings)
+        if report:
+            index.write_report()
+        return index
+
+    def approximate_search(self, query, k=4, rerank=True):
+        query = np.asarray(query, dtype=np.float32).reshape(1, -1)
+        fetch = min(self.count, k * self.rerank_factor if rerank else k)
+        distances, ids = self.index.search(query, fetch)
+        candidates = ids[0][ids[0] >= 0]
+        if not rerank or not len(candidates):
+            return candidates[:k], distances[0][:len(candidates)][:k]
+
+        # Re-score candidates exactly; sorted ids keep the mmap reads sequential
+        candidates = np.sort(candidates)
+        rows = np.asarray(self.vectors[candidates], dtype=np.float32)
+        exact = self.norms[candidates] - 2 * (rows @ query[0]) + float(query[0] @ query[0])
+        order = np.argsort(exact)[:k]
+        return candidates[order], exact[order]
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, **kwargs):
+        if not self.count:
+            return []
+        ids, distances = self.approximate_search(embedding, k)
+        return [(self.document(int(i)), float(d)) for i, d in zip(ids, distances)]
+
+    def evaluate(self, k=4, num_queries=100, seed=0):
+        """Recall@k and latency against exact flat search, using perturbed stored vectors as queries."""
+        rng = np.random.default_rng(seed)
+        sample = rng.choice(self.count, size=min(num_queries, self.count), replace=False)
+        queries = np.asarray(self.vectors[np.sort(sample)], dtype=np.float32)
+        queries += rng.normal(scale=float(queries.std()) * 0.1, size=queries.shape).astype(np.float32)
+
+        def timed(search):
+            start = time.perf_counter()
+            results = [set(search(q).tolist()) for q in queries]
+            return results, (time.perf_counter() - start) * 1000 / len(queries)
+
+        flat, flat_ms = timed(lambda q: self.exact_search(q, k)[0])
+        raw, raw_ms = timed(lambda q: self.approximate_search(q, k, rerank=False)[0])
+        reranked, reranked_ms = timed(lambda q: self.approximate_search(q, k)[0])
+
+        def recall(results):
+            return round(sum(len(a & b) for a, b in zip(results, flat)) / sum(len(b) for b in flat), 4)
+
+        flat_bytes = self.count * self.dim * 4
+        return {
+            'index_type': self.config['index_type'],
+            'vectors': self.count,
+            'k': k,
+            'queries': len(queries),
+            'recall_at_k': recall(raw),
+            'recall_at_k_reranked': recall(reranked),
+            'flat_ms_per_query': round(flat_ms, 3),
+            'quantized_ms_per_query': round(raw_ms, 3),
+            'reranked_ms_per_query': round(reranked_ms, 3),
+            'flat_bytes': flat_bytes,
+            'quantized_bytes': self.memory_bytes,
+            'compression': round(flat_bytes / self.memory_bytes, 1) if self.memory_bytes else None
+        }
+
+    def write_report(self, k=4):
+        report = self.evaluate(k=k)
+        with open(os.path.join(self.path, 'report.json'), 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        logging.info(f"Quantized index report: {report}")
+        return report
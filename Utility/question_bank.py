@@ -0,0 +1,83 @@
+import hashlib
+import logging
+from datetime import datetime
+
+from pymongo import UpdateOne
+
+
+class QuestionBank:
+    """Store of every validated question, indexed on the fields requests select by."""
+
+    # bank field -> request field
+    FIELDS = {
+        'subject': 'subjectName',
+        'class': 'classGrade',
+        'topic': 'sectionName',
+        'difficulty': 'difficulty',
+        'bloomLevel': 'bloomLevel',
+        'questionType': 'questionType'
+    }
+
+    def __init__(self, collection):
+        self.collection = collection
+        try:
+            self.collection.create_index(
+                [(field, 1) for field in self.FIELDS] + [('context_id', 1)],
+                name='selection_fields'
+            )
+            self.collection.create_index('question_hash', unique=True)
+        except Exception as e:
+            logging.warning(f"Question bank index creation failed: {e}")
+
+    @classmethod
+    def selector(cls, topic_data, context_id=None):
+        """Normalised filter so 'Algebra ' and 'algebra' share bank entries."""
+        query = {
+            field: str(topic_data.get(source, '')).strip().lower()
+            for field, source in cls.FIELDS.items()
+        }
+        query['context_id'] = context_id
+        return query
+
+    def add(self, topic_data, questions, context_id=None):
+        """Insert questions into the bank, ignoring ones it already holds."""
+        if not questions:
+            return 0
+        selector = self.selector(topic_data, context_id)
+        operations = []
+        for question in questions:
+            text = ' '.join(str(question.get('question', '')).lower().split())
+            question_hash = hashlib.sha256(
+                f"{sorted(selector.items())}|{text}".encode()
+            ).hexdigest()
+            operations.append(UpdateOne(
+                {'question_hash': question_hash},
+                {'$setOnInsert': {
+                    **selector,
+                    'question_hash': question_hash,
+                    'question': question,
+                    'created_at': datetime.utcnow()
+                }},
+                upsert=True
+            ))
+        try:
+            result = self.collection.bulk_write(operations, ordered=False)
+            return result.upserted_count
+        except Exception as e:
+            logging.warning(f"Question bank insert failed: {e}")
+            return 0
+
+    def fetch(self, topic_data, limit, context_id=None):
+        """Return up to `limit` random questions matching the topic's fields."""
+        if limit <= 0:
+            return []
+        try:
+            docs = self.collection.aggregate([
+                {'$match': self.selector(topic_data, context_id)},
+                {'$sample': {'size': limit}},
+                {'$project': {'_id': 0, 'question': 1}}
+            ])
+            return [doc['question'] for doc in docs]
+        except Exception as e:
+            logging.warning(f"Question bank lookup failed: {e}")
+            return []
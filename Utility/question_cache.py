@@ -0,0 +1,113 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+
+class QuestionCache:
+    """Two-tier cache for generated question batches.
+
+    Tier one is a size-bounded in-process LRU; tier two is a MongoDB
+    collection whose documents expire through a TTL index on `created_at`.
+    """
+
+    KEY_FIELDS = ['subjectName', 'classGrade', 'sectionName', 'questionType',
+                  'difficulty', 'bloomLevel', 'numQuestions', 'additionalInstructions']
+
+    def __init__(self, collection=None, max_entries=512, ttl_seconds=7 * 24 * 3600):
+        self.collection = collection
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {'memory_hits': 0, 'mongo_hits': 0, 'misses': 0, 'stores': 0}
+
+        if self.collection is not None:
+            try:
+                self.collection.create_index('cache_key', unique=True)
+                self.collection.create_index('created_at', expireAfterSeconds=ttl_seconds)
+            except Exception as e:
+                logging.warning(f"Question cache index creation failed: {e}")
+
+    @classmethod
+    def make_key(cls, topic_data, batch_index=0, context_id=None):
+        """Hash the request fields that shape a batch's questions.
+
+        The batch's position within its topic is part of the key so that
+        a topic split into several batches does not get the same questions twice.
+        """
+        key_data = {field: str(topic_data.get(field, '')) for field in cls.KEY_FIELDS}
+        key_data['batch_index'] = batch_index
+        key_data['context_id'] = context_id
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+
+    @classmethod
+    def make_plan_key(cls, topic_data, context_id=None):
+        """Key for the batch sizes a topic was split into; numQuestions is the topic's total."""
+        return cls.make_key(topic_data, 'plan', context_id)
+
+    def _lookup(self, key):
+        """Return (value, tier) with tier 'memory', 'mongo' or None on a miss."""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key], 'memory'
+
+        if self.collection is not None:
+            try:
+                doc = self.collection.find_one({'cache_key': key})
+            except Exception as e:
+                logging.warning(f"Question cache lookup failed: {e}")
+                doc = None
+            if doc:
+                self._remember(key, doc['questions'])
+                return doc['questions'], 'mongo'
+        return None, None
+
+    def get(self, key):
+        questions, tier = self._lookup(key)
+        with self._lock:
+            self.stats[f'{tier}_hits' if tier else 'misses'] += 1
+        return questions
+
+    def put(self, key, questions):
+        self._store(key, questions)
+        with self._lock:
+            self.stats['stores'] += 1
+
+    def get_plan(self, key):
+        """Batch sizes stored for a topic, or None. Plans are not counted in the stats."""
+        return self._lookup(key)[0]
+
+    def put_plan(self, key, plan):
+        self._store(key, plan)
+
+    def _store(self, key, questions):
+        self._remember(key, questions)
+
+        if self.collection is not None:
+            try:
+                self.collection.update_one(
+                    {'cache_key': key},
+                    {'$set': {'questions': questions, 'created_at': datetime.utcnow()}},
+                    upsert=True
+                )
+            except Exception as e:
+                logging.warning(f"Question cache store failed: {e}")
+
+    def _remember(self, key, questions):
+        with self._lock:
+            self._memory[key] = questions
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['memory_entries'] = len(self._memory)
+        lookups = stats['memory_hits'] + stats['mongo_hits'] + stats['misses']
+        stats['hit_rate'] = round((lookups - stats['misses']) / lookups, 3) if lookups else 0.0
+        return stats
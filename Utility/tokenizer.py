@@ -0,0 +1,30 @@
+import re
+
+# Pieces the way GPT byte-pair encoders pre-split text: contractions, words
+# with their leading space, runs of up to three digits, punctuation, spaces
+PIECE_RE = re.compile(r"'(?:[sdmt]|ll|ve|re)| ?[^\W\d_]+| ?\d{1,3}| ?[^\s\w]+|\s+(?!\S)|\s+|_+", re.IGNORECASE)
+
+
+class OfflineEncoder:
+    """Approximate token encoder that needs no vocabulary file.
+
+    Text is pre-split like cl100k and words longer than `max_word` letters
+    count one token per `max_word` letters, which tracks real counts on
+    prose closely enough for chunk sizing and context budgets. Tokens are
+    the text pieces themselves, so decode(encode(text)) == text.
+    """
+
+    def __init__(self, max_word=6):
+        self.max_word = max_word
+
+    def encode(self, text):
+        tokens = []
+        for piece in PIECE_RE.findall(text):
+            if len(piece) <= self.max_word + 1:
+                tokens.append(piece)
+                continue
+            tokens.extend(piece[i:i + self.max_word] for i in range(0, len(piece), self.max_word))
+        return tokens
+
+    def decode(self, tokens):
+        return ''.join(tokens)
@@ -0,0 +1,153 @@
+import hashlib
+import logging
+import os
+import queue
+import threading
+
+MIN_PART_SIZE = 5 * 1024 * 1024  # S3 rejects smaller multipart parts, except the last
+
+
+class S3UploadStream:
+    """Writable stream that spools, hashes and uploads an upload in one pass.
+
+    Every write goes to the local spool file and the running sha256.
+    Writes are also collected into S3 parts; full parts are handed to a
+    background thread through a bounded queue, so at most
+    `max_pending_parts + 1` parts are held in memory and a slow S3
+    connection throttles the reader instead of growing the buffer. Files
+    smaller than one part are sent with a single put_object.
+
+    Used as the werkzeug file stream of an upload, it reads like the spool
+    file once the form is parsed. Call `finish()` to complete the upload or
+    `abort()` to discard it; closing an unfinished stream aborts.
+    """
+
+    def __init__(self, s3_client, bucket, key, spool_path, content_type='application/octet-stream',
+                 part_size=8 * 1024 * 1024, max_pending_parts=2):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.spool_path = spool_path
+        self.content_type = content_type
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.part_count = 0
+        self.error = None
+        self.done = False
+        self.pending = queue.Queue(maxsize=max_pending_parts)
+        self.uploader = None
+        os.makedirs(os.path.dirname(spool_path) or '.', exist_ok=True)
+        self.spool = open(spool_path, 'w+b')
+
+    def write(self, data):
+        if self.error:
+            raise self.error
+        self.spool.write(data)
+        self.sha256.update(data)
+        self.size += len(data)
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self._send_part(part)
+        return len(data)
+
+    def _send_part(self, data):
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, ContentType=self.content_type)['UploadId']
+            self.uploader = threading.Thread(target=self._upload_parts, name='s3-part-uploader', daemon=True)
+            self.uploader.start()
+        self.part_count += 1
+        self.pending.put((self.part_count, data))
+
+    def _upload_parts(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            if self.error:
+                continue  # keep draining so the writer never blocks
+            number, data = item
+            try:
+                response = self.s3_client.upload_part(
+                    Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=number, Body=data)
+                self.parts.append({'PartNumber': number, 'ETag': response['ETag']})
+            except Exception as e:
+                self.error = e
+
+    def _stop_uploader(self):
+        if self.uploader:
+            self.pending.put(None)
+            self.uploader.join()
+            self.uploader = None
+
+    def hexdigest(self):
+        """sha256 of everything written so far, available before the upload is finished."""
+        return self.sha256.hexdigest()
+
+    def finish(self, key=None):
+        """Complete the S3 upload, optionally under a new key; returns the content hash, size and key.
+
+        A single-part upload is written straight to `key`. A multipart
+        upload is completed under its original key, then copied to `key`
+        and the original deleted.
+        """
+        self.spool.flush()
+        if self.upload_id is None:
+            self.key = key or self.key
+            self.s3_client.put_object(
+                Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), ContentType=self.content_type)
+        else:
+            if self.buffer:
+                self._send_part(bytes(self.buffer))
+            self._stop_uploader()
+            if self.error:
+                self.abort()
+                raise self.error
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={'Parts': sorted(self.parts, key=lambda part: part['PartNumber'])})
+            if key and key != self.key:
+                self.s3_client.copy_object(
+                    Bucket=self.bucket, Key=key, CopySource={'Bucket': self.bucket, 'Key': self.key})
+                self.s3_client.delete_object(Bucket=self.bucket, Key=self.key)
+                self.key = key
+        self.buffer = bytearray()
+        self.done = True
+        logging.info(f"Uploaded {self.size} bytes to s3://{self.bucket}/{self.key} in {max(self.part_count, 1)} part(s)")
+        return {'sha256': self.sha256.hexdigest(), 'size': self.size, 'key': self.key}
+
+    def abort(self, remove_spool=True):
+        self.done = True
+        self._stop_uploader()
+        if self.upload_id is not None:
+            try:
+                self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            except Exception as e:
+                logging.warning(f"Could not abort multipart upload {self.upload_id}: {e}")
+        self.spool.close()
+        if remove_spool and os.path.exists(self.spool_path):
+            os.remove(self.spool_path)
+
+    # File-like reads and seeks go to the spool file
+    def read(self, size=-1):
+        return self.spool.read(size)
+
+    def readline(self, size=-1):
+        return self.spool.readline(size)
+
+    def seek(self, offset, whence=0):
+        return self.spool.seek(offset, whence)
+
+    def tell(self):
+        return self.spool.tell()
+
+    def close(self):
+        if not self.done:
+            self.abort()
+        self.spool.close()
@@ -2,23 +2,30 @@ import os
 import logging
 from datetime import datetime, timedelta
 
-log_dir = "logging"
-os.makedirs(log_dir, exist_ok=True)
-log_filename = f"{log_dir}/app_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
-logging.basicConfig(
-    filename=log_filename,
-    level=logging.INFO,
-    format='%(message)s'
-)
-logging.info("Test log entry: Logging is working.")
+# PDF extraction workers are spawned processes, started once and reused, which
+# re-import this module as __mp_main__. They only need its imports: no log file,
+# clients or job queues
+SPAWNED_WORKER = __name__ == '__mp_main__'
+
+if not SPAWNED_WORKER:
+    log_dir = "logging"
+    os.makedirs(log_dir, exist_ok=True)
+    log_filename = f"{log_dir}/app_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+    logging.basicConfig(
+        filename=log_filename,
+        level=logging.INFO,
+        format='%(message)s'
+    )
+    logging.info("Test log entry: Logging is working.")
 
-print("Logging to:", os.path.abspath(log_filename))  # Add this for debugging
+    print("Logging to:", os.path.abspath(log_filename))  # Add this for debugging
 
 
 
-from flask import Flask, request, jsonify, send_from_directory, make_response
+from flask import Flask, Request, request, jsonify, send_from_directory, make_response, Response, stream_with_context
 from flask_cors import CORS
 from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError
 
 from dotenv import load_dotenv
 import pytz
@@ -31,7 +38,10 @@ from botocore.exceptions import ClientError
 import io
 import asyncio
 import hashlib
-#from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import mylang4  # Import the LangChain module
 #from langchain.vectorstores import Chroma
 from langchain.embeddings import OpenAIEmbeddings
@@ -39,9 +49,17 @@ from langchain.embeddings import OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain_openai import OpenAIEmbeddings
 from Utility.pdfmaker import CreatePDF
+from Utility.jobs import JobQueue
+from Utility.question_cache import QuestionCache
+from Utility.question_bank import QuestionBank
+from Utility.batch_planner import BatchPlanner
+from Utility.index_registry import IndexRegistry
+from Utility.upload_stream import S3UploadStream
+from Utility.file_cache import prune_directory, touch
 
 import re
 import gc
+import shutil
 import psutil
 
 # Load environment variables
@@ -54,26 +72,37 @@ app = Flask(__name__, static_folder='dist', static_url_path='')
 CORS(app, resources={
     r"/*": {
         "origins": "*",
-        "methods": ["GET", "POST", "OPTIONS"],
+        "methods": ["GET", "POST", "DELETE", "OPTIONS"],
         "allow_headers": ["Content-Type"]
     }
 })
 
 # Initialize MongoDB with configurable database and collections
-try:
-    MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017')
-    DB_NAME = os.getenv('DB_NAME', 'question_paper_db')
-    REQUEST_COLLECTION = os.getenv('REQUEST_COLLECTION', 'question_requests')
-    PAPER_COLLECTION = os.getenv('PAPER_COLLECTION', 'question_papers')
-    
-    client = MongoClient(MONGODB_URI)
-    db = client[DB_NAME]
-    requests_collection = db[REQUEST_COLLECTION]
-    papers_collection = db[PAPER_COLLECTION]
-    logging.info("✅ MongoDB Connection Successful!")
-except Exception as e:
-    logging.info(f"❌ MongoDB Connection Error: {e}")
+if SPAWNED_WORKER:
     db = None
+else:
+    try:
+        MONGODB_URI = os.getenv('MONGODB_URI', 'mongodb://localhost:27017')
+        DB_NAME = os.getenv('DB_NAME', 'question_paper_db')
+        REQUEST_COLLECTION = os.getenv('REQUEST_COLLECTION', 'question_requests')
+        PAPER_COLLECTION = os.getenv('PAPER_COLLECTION', 'question_papers')
+        JOB_COLLECTION = os.getenv('JOB_COLLECTION', 'generation_jobs')
+        CACHE_COLLECTION = os.getenv('CACHE_COLLECTION', 'question_cache')
+        BANK_COLLECTION = os.getenv('BANK_COLLECTION', 'question_bank')
+    
+        client = MongoClient(MONGODB_URI)
+        db = client[DB_NAME]
+        requests_collection = db[REQUEST_COLLECTION]
+        papers_collection = db[PAPER_COLLECTION]
+        jobs_collection = db[JOB_COLLECTION]
+        cache_collection = db[CACHE_COLLECTION]
+        bank_collection = db[BANK_COLLECTION]
+        notes_collection = db['notes']
+        notes_collection.create_index('content_hash')
+        logging.info("✅ MongoDB Connection Successful!")
+    except Exception as e:
+        logging.info(f"❌ MongoDB Connection Error: {e}")
+        db = None
 
 # Initialize OpenAI client
 try:
@@ -93,19 +122,45 @@ except Exception as e:
     raise
 
 # Initialize AWS S3 client
-try:
-    s3_client = boto3.client(
-        's3',
-        aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
-        aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
-        region_name=os.getenv('AWS_REGION', 'us-east-1')
-    )
-    S3_BUCKET = os.getenv('S3_BUCKET_NAME')
-    NOTES_BUCKET = os.getenv('NOTES_BUCKET_NAME')  # Separate bucket for notes
-    logging.info("✅ AWS S3 Connection Successful!")
-except Exception as e:
-    logging.info(f"❌ AWS S3 Connection Error: {e}")
+if SPAWNED_WORKER:
     s3_client = None
+else:
+    try:
+        s3_client = boto3.client(
+            's3',
+            aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'),
+            aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'),
+            region_name=os.getenv('AWS_REGION', 'us-east-1')
+        )
+        S3_BUCKET = os.getenv('S3_BUCKET_NAME')
+        NOTES_BUCKET = os.getenv('NOTES_BUCKET_NAME')  # Separate bucket for notes
+        logging.info("✅ AWS S3 Connection Successful!")
+    except Exception as e:
+        logging.info(f"❌ AWS S3 Connection Error: {e}")
+        s3_client = None
+
+    UPLOAD_PART_SIZE = int(os.getenv('UPLOAD_PART_MB', 8)) * 1024 * 1024
+
+class NoteUploadRequest(Request):
+    """Streams note uploads to disk, sha256 and S3 while the form is parsed."""
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint != 'upload_note' or s3_client is None:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        note_id = ObjectId()
+        stream = S3UploadStream(
+            s3_client,
+            NOTES_BUCKET,
+            # Moved to its content-addressed key once the hash is known
+            key=f"notes/uploads/{note_id}.pdf",
+            spool_path=os.path.join('temp_uploads', f'{note_id}.pdf'),
+            content_type='application/pdf',
+            part_size=UPLOAD_PART_SIZE
+        )
+        stream.note_id = note_id
+        return stream
+
+app.request_class = NoteUploadRequest
 
 # Add memory monitoring function
 def monitor_memory():
@@ -135,118 +190,434 @@ def serve_static(path):
     return send_from_directory(app.static_folder, 'index.html')
 
 
-# Initialize the question generator
-#question_generator = QuestionPromptGenerator()
-@app.route('/api/generate-questions', methods=['POST'])
-def generate_questions():
-    try:
-        logging.info("Received request at /api/generate-questions")
-        data = request.get_json()
+# Batch execution settings
+DEFAULT_BATCH_SIZE = 5
+BATCH_MODE = os.getenv('BATCH_MODE', 'adaptive')  # 'adaptive' or 'fixed'
+GENERATION_MODE = os.getenv('GENERATION_MODE', 'sequential')  # 'sequential' or 'concurrent'
+MAX_CONCURRENT_BATCHES = int(os.getenv('MAX_CONCURRENT_BATCHES', 6))
 
-        if not data:
-            return jsonify({'success': False, 'error': 'No data provided'}), 400
+# Question cache in front of the LLM
+question_cache = QuestionCache(
+    cache_collection if db is not None else None,
+    max_entries=int(os.getenv('CACHE_MAX_ENTRIES', 512)),
+    ttl_seconds=int(os.getenv('CACHE_TTL_SECONDS', 7 * 24 * 3600))
+)
 
-        # Validate required fields
-        required_fields = ['subjectName', 'classGrade', 'topics']
-        for field in required_fields:
-            if field not in data:
-                return jsonify({'success': False, 'error': f"Missing required field: {field}"}), 400
+# Question bank of previously generated questions
+QUESTION_SOURCE_MODE = os.getenv('QUESTION_SOURCE_MODE', 'generate')  # 'generate' or 'bank_first'
+question_bank = QuestionBank(bank_collection) if db is not None else None
 
-        # Insert request metadata
-        data['created_at'] = datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%Y-%m-%d %H:%M:%S')
-        request_id = requests_collection.insert_one(data).inserted_id
+# Batch sizes sized to the model's output budget
+batch_planner = BatchPlanner(
+    max_output_tokens=int(os.getenv('MODEL_MAX_OUTPUT_TOKENS', 4096)),
+    max_batch_size=int(os.getenv('MAX_BATCH_SIZE', 15)),
+    target_batch_seconds=float(os.getenv('TARGET_BATCH_SECONDS', 0)) or None,
+    min_backoff_size=int(os.getenv('MIN_BACKOFF_BATCH_SIZE', 3))
+)
 
-        # Load vectorstore if exists
-        vectorstore_path = "vectorstores/latest"
-        vectorstore = None
-        if os.path.exists(vectorstore_path):
-            try:
-                embeddings = OpenAIEmbeddings()
-                vectorstore = FAISS.load_local(vectorstore_path, embeddings, allow_dangerous_deserialization=True)
-                logging.info(f"Loaded vectorstore from {vectorstore_path}")
-            except Exception as e:
-                logging.warning(f"Vectorstore load failed: {e}")
+def plan_topic_batches(data, topic_data, num_qs, context_id=None):
+    """Batch sizes for one topic: fixed when requested, otherwise from the planner.
 
-        # Generate questions for each topic in batches
-        all_questions = []
-        for topic in data['topics']:
-            topic_data = {
-                **topic,
-                'subjectName': data['subjectName'],
-                'classGrade': data['classGrade']
-            }
+    An adaptive plan is stored in the question cache, so a repeated request
+    splits the topic the same way and its batches hit the cache even after
+    the planner's estimates have moved.
+    """
+    batch_size = data.get('batchSize')
+    if batch_size or BATCH_MODE != 'adaptive':
+        try:
+            batch_size = max(1, int(batch_size or DEFAULT_BATCH_SIZE))
+        except (TypeError, ValueError):
+            batch_size = DEFAULT_BATCH_SIZE
+        return [min(batch_size, num_qs - i) for i in range(0, num_qs, batch_size)]
+    plan_key = QuestionCache.make_plan_key({**topic_data, 'numQuestions': num_qs}, context_id)
+    plan = question_cache.get_plan(plan_key)
+    if not isinstance(plan, list) or sum(plan) != num_qs:
+        plan = batch_planner.plan(num_qs, topic_data.get('questionType', ''), topic_data.get('difficulty', ''))
+        question_cache.put_plan(plan_key, plan)
+    return plan
+
+def build_batches(data):
+    """Split every topic of a request into LLM batches, in paper order.
+
+    In 'bank_first' source mode each topic starts with a batch served from
+    the question bank, and only the shortfall is sent to the LLM.
+    """
+    use_cache = not data.get('bypassCache', False)
+    use_bank = question_bank is not None and data.get('sourceMode', QUESTION_SOURCE_MODE) == 'bank_first'
+    batches = []
+    for topic_index, topic in enumerate(data['topics']):
+        topic_data = {
+            **topic,
+            'subjectName': data['subjectName'],
+            'classGrade': data['classGrade']
+        }
 
+        try:
+            num_qs = int(topic.get('numQuestions', 1))
+        except ValueError:
+            num_qs = 1
+
+        note_ids = topic_note_ids(data, topic)
+        notes_key = ','.join(note_ids) or None
+        context_id = get_context_id(note_ids)
+
+        if use_bank:
+            bank_questions = question_bank.fetch(topic_data, num_qs, context_id)
+            if bank_questions:
+                batches.append({
+                    'index': len(batches),
+                    'topic_index': topic_index,
+                    'data': {**topic_data, 'numQuestions': len(bank_questions)},
+                    'questions': bank_questions
+                })
+                num_qs -= len(bank_questions)
+
+        for topic_batch, current_batch in enumerate(plan_topic_batches(data, topic_data, num_qs, context_id)):
+            batch_data = {**topic_data, 'numQuestions': current_batch}
+            batches.append({
+                'index': len(batches),
+                'topic_index': topic_index,
+                'data': batch_data,
+                'topic_batch': topic_batch,
+                'cache_key': QuestionCache.make_key(batch_data, topic_batch, context_id),
+                'use_cache': use_cache,
+                'context_id': context_id,
+                'notes_key': notes_key
+            })
+    return batches
+
+def run_batch(batch, retrievals, on_question=None):
+    """Generate one batch of questions and time the LLM round trip.
+
+    With `on_question(batch, question)`, each LLM question is passed on as
+    soon as it is parsed from the stream, before the batch completes.
+    """
+    start = time.perf_counter()
+    source = 'llm'
+    if 'questions' in batch:
+        questions = batch['questions']
+        source = 'bank'
+    else:
+        cache_key = batch.get('cache_key')
+        questions = question_cache.get(cache_key) if cache_key and batch.get('use_cache', True) else None
+        if questions is not None:
+            source = 'cache'
+        else:
+            batch_data = batch['data']
+            retrieval = (retrievals or {}).get(batch.get('notes_key'))
             try:
-                num_qs = int(topic.get('numQuestions', 1))
+                if on_question:
+                    questions = []
+                    for question in mylang4.question_generator.stream_questions(batch_data, retrieval):
+                        questions.append(question)
+                        on_question(batch, question)
+                else:
+                    questions = mylang4.question_generator.generate_questions(batch_data, retrieval)['questions']
             except ValueError:
-                num_qs = 1
+                # Unparseable or invalid reply; network errors and timeouts are not the batch size's fault
+                batch_planner.observe(batch_data.get('questionType', ''), batch_data.get('difficulty', ''),
+                                      batch_data['numQuestions'], failed=True)
+                raise
+            batch_planner.observe(
+                batch_data.get('questionType', ''), batch_data.get('difficulty', ''),
+                batch_data['numQuestions'], returned=len(questions),
+                output_tokens=mylang4.count_tokens(json.dumps(questions)),
+                seconds=time.perf_counter() - start
+            )
+            if cache_key:
+                question_cache.put(cache_key, questions)
+            if question_bank is not None:
+                question_bank.add(batch['data'], questions, batch.get('context_id'))
+    timing = {
+        'batch': batch['index'],
+        'topic': batch['data'].get('sectionName', ''),
+        'num_questions': batch['data']['numQuestions'],
+        'seconds': round(time.perf_counter() - start, 3),
+        'cached': source != 'llm',
+        'source': source
+    }
+    return questions, timing
 
-            batch_size = 5
-            topic_questions = []
+def get_concurrency(data):
+    """Resolve how many batches may run at once for this request."""
+    mode = data.get('executionMode', GENERATION_MODE)
+    if mode != 'concurrent':
+        return 1
+    try:
+        limit = int(data.get('maxConcurrency', MAX_CONCURRENT_BATCHES))
+    except (TypeError, ValueError):
+        limit = MAX_CONCURRENT_BATCHES
+    return max(1, min(limit, MAX_CONCURRENT_BATCHES))
 
-            for i in range(0, num_qs, batch_size):
-                current_batch = min(batch_size, num_qs - i)
-                batch_data = {**topic_data, 'numQuestions': current_batch}
+def iter_batches(batches, retrievals, concurrency=1, on_question=None):
+    """Yield (batch, questions, timing) as each batch finishes."""
+    if concurrency <= 1 or len(batches) <= 1:
+        for batch in batches:
+            questions, timing = run_batch(batch, retrievals, on_question)
+            yield batch, questions, timing
+            # Free memory
+            gc.collect()
+        return
 
-                questions = mylang4.question_generator.generate_questions(batch_data, vectorstore)
-                topic_questions.extend(questions['questions'])
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(batches))) as executor:
+        futures = {executor.submit(run_batch, batch, retrievals, on_question): batch for batch in batches}
+        for future in as_completed(futures):
+            questions, timing = future.result()
+            yield futures[future], questions, timing
 
-                # Free memory
-                gc.collect()
+def iter_batch_events(batches, retrievals, concurrency=1):
+    """Yield ('question', batch, question) as LLM questions are parsed and
+    ('batch', batch, questions, timing) as batches finish.
 
-            all_questions.append({
-                'topic': topic.get('sectionName', ''),
-                'questions': topic_questions,
-                'cached': False
-            })
+    Batches run on a producer thread so questions reach the caller while
+    the model is still writing the rest of the batch. Closing the generator
+    stops the producer at the next question.
+    """
+    events = queue.Queue()
+    stop = threading.Event()
 
-        # Save to MongoDB
-        paper_data = {
-            'request_id': str(request_id),
-            'questions': all_questions,
-            'created_at': datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%Y-%m-%d %H:%M:%S'),
-            'previous_paper_id': data.get('previous_paper_id')
-        }
-        paper_id = papers_collection.insert_one(paper_data).inserted_id
-
-        # Generate PDFs
-        pdf_filename = f"question_paper_{paper_id}.pdf"
-        pdf_buffer = CreatePDF.generate(
-            all_questions,
-            pdf_filename,
-            class_grade=data['classGrade'],
-            subject_name=data['subjectName']
-        )
+    def on_question(batch, question):
+        if stop.is_set():
+            raise RuntimeError("Batch stream closed by the client")
+        events.put(('question', batch, question))
 
-        s3_client.upload_fileobj(
-            pdf_buffer,
-            S3_BUCKET,
-            pdf_filename,
-            ExtraArgs={'ContentType': 'application/pdf'}
-        )
+    def produce():
+        try:
+            for batch, questions, timing in iter_batches(batches, retrievals, concurrency, on_question):
+                events.put(('batch', batch, questions, timing))
+                if stop.is_set():
+                    break
+        except Exception as e:
+            events.put(('error', e))
+        finally:
+            events.put(None)
 
-        pdf_url = s3_client.generate_presigned_url(
-            'get_object',
-            Params={'Bucket': S3_BUCKET, 'Key': pdf_filename},
-            ExpiresIn=3600
-        )
+    threading.Thread(target=produce, name='batch-events', daemon=True).start()
+    try:
+        while True:
+            event = events.get()
+            if event is None:
+                return
+            if event[0] == 'error':
+                raise event[1]
+            yield event
+    finally:
+        stop.set()
 
-        # Final cleanups
-        if os.path.exists(vectorstore_path):
-            try:
-                import shutil
-                shutil.rmtree(vectorstore_path)
-                logging.info(f"Cleaned up vectorstore directory: {vectorstore_path}")
-            except Exception as e:
-                logging.warning(f"Failed to delete vectorstore directory: {e}")
+def assemble_questions(topics, results, timings=None):
+    """Rebuild the per-topic question lists in request order from batch results."""
+    cached_batches = {timing['batch'] for timing in (timings or []) if timing.get('cached')}
+    all_questions = [{
+        'topic': topic.get('sectionName', ''),
+        'questions': [],
+        'cached': False
+    } for topic in topics]
+    topic_batches = {}
+    for batch, questions in sorted(results, key=lambda item: item[0]['index']):
+        all_questions[batch['topic_index']]['questions'].extend(questions)
+        topic_batches.setdefault(batch['topic_index'], []).append(batch['index'] in cached_batches)
+    for topic_index, flags in topic_batches.items():
+        all_questions[topic_index]['cached'] = all(flags)
+    return all_questions
 
-        
+# Per-note vector indexes, referenced from the notes collection
+NOTES_INDEX_DIR = os.getenv('NOTES_INDEX_DIR', 'vectorstores/notes')
+
+def get_note(note_id):
+    try:
+        return notes_collection.find_one({'_id': ObjectId(note_id)})
+    except Exception:
+        return None
+
+def topic_note_ids(data, topic):
+    """Notes a topic draws context from: its own noteId, else the paper's noteIds."""
+    note_ids = [topic['noteId']] if topic.get('noteId') else data.get('noteIds') or []
+    return sorted({str(note_id) for note_id in note_ids if ObjectId.is_valid(str(note_id))})
+
+# 'latest' gives a paper that names no notes the most recently analysed one, as the single
+# shared index did before per-note indexes; 'none' generates it without note context
+NOTE_CONTEXT_FALLBACK = os.getenv('NOTE_CONTEXT_FALLBACK', 'latest')
+
+def use_latest_note(data):
+    """Point a request that names no notes at the most recently analysed note."""
+    if NOTE_CONTEXT_FALLBACK != 'latest' or data.get('noteIds'):
+        return
+    if any(isinstance(topic, dict) and topic.get('noteId') for topic in data.get('topics') or []):
+        return
+    note = notes_collection.find_one({'analysed_at': {'$exists': True}}, sort=[('analysed_at', -1)])
+    if note:
+        data['noteIds'] = [str(note['_id'])]
+        logging.info(f"No notes given; using the most recently analysed note {note['_id']}")
+
+def read_vectorstore(vectorstore_path):
+    vectorstore = mylang4.document_processor.load_index(vectorstore_path)
+    logging.info(f"Loaded vectorstore from {vectorstore_path}")
+    return vectorstore
+
+# Hot note indexes stay loaded between requests
+index_registry = IndexRegistry(
+    read_vectorstore,
+    max_bytes=int(os.getenv('INDEX_CACHE_MAX_MB', 1024)) * 1024 * 1024
+)
+
+def load_vectorstore(vectorstore_path):
+    """Get a note's vector index from the registry, loading it from disk on a miss."""
+    if not vectorstore_path or not os.path.exists(vectorstore_path):
+        return None
+    try:
+        return index_registry.get(vectorstore_path)
+    except Exception as e:
+        logging.warning(f"Vectorstore load failed: {e}")
+        return None
+
+def get_context_id(note_ids):
+    """Identify the indexed notes a batch uses so cached questions follow their notes."""
+    if not note_ids:
+        return None
+    notes = notes_collection.find(
+        {'_id': {'$in': [ObjectId(note_id) for note_id in note_ids]}},
+        {'index_version': 1}
+    )
+    return ','.join(sorted(f"{note['_id']}@{note.get('index_version', 0)}" for note in notes)) or None
+
+def note_index_path(note, allow_partial=False):
+    ingestion = note.get('ingestion') or {}
+    if allow_partial and ingestion.get('status') in ('queued', 'running'):
+        partial_path = partial_index_dir(ingestion['vectorstore_path'])
+        if os.path.isdir(partial_path):
+            return partial_path
+    return note.get('vectorstore_path')
+
+def prepare_retrieval(batches, allow_partial=False):
+    """Build one retrieval context per distinct note set, each fetching a topic's context once.
+
+    With allow_partial, a note still being ingested is searched through its latest checkpoint.
+    Batches are re-keyed to the notes whose indexes actually loaded, so questions
+    generated without a note's context are never cached as grounded in it.
+    """
+    vectorstores = {}
+    versions = {}
+    retrievals = {}
+    for batch in batches:
+        notes_key = batch.get('notes_key')
+        if not notes_key or notes_key in retrievals:
+            continue
+        for note_id in notes_key.split(','):
+            if note_id not in vectorstores:
+                note = get_note(note_id)
+                if note and note.get('embedding_model', mylang4.document_processor.embedding_model) != mylang4.document_processor.embedding_model:
+                    logging.warning(f"Note {note_id} was indexed with {note['embedding_model']}; re-analyse it to use it here")
+                    note = None
+                index_path = note_index_path(note, allow_partial) if note else None
+                vectorstores[note_id] = load_vectorstore(index_path)
+                if vectorstores[note_id] is not None:
+                    # A checkpoint is not the finished index, so it gets a context of its own
+                    partial = '+partial' if index_path != note.get('vectorstore_path') else ''
+                    versions[note_id] = f"{note_id}@{note.get('index_version', 0)}{partial}"
+        loaded = [vectorstores[note_id] for note_id in notes_key.split(',') if vectorstores[note_id] is not None]
+        if loaded:
+            retrievals[notes_key] = mylang4.RetrievalContext(loaded)
+
+    for batch in batches:
+        if not batch.get('notes_key') or 'questions' in batch:
+            continue
+        context_id = ','.join(sorted(versions[note_id] for note_id in batch['notes_key'].split(',')
+                                     if note_id in versions)) or None
+        if context_id != batch.get('context_id'):
+            logging.warning(f"Batch {batch['index']} uses context {context_id} instead of {batch.get('context_id')}")
+            batch['context_id'] = context_id
+            batch['cache_key'] = (QuestionCache.make_key(batch['data'], batch['topic_batch'], context_id)
+                                  if 'topic_batch' in batch else None)
+
+    for notes_key, retrieval in retrievals.items():
+        retrieval.prefetch([batch['data'] for batch in batches
+                            if batch.get('notes_key') == notes_key and 'questions' not in batch])
+    return retrievals
+
+def validate_generation_request(data):
+    """Return an error message for a malformed generation request, else None."""
+    if not data:
+        return 'No data provided'
+    required_fields = ['subjectName', 'classGrade', 'topics']
+    for field in required_fields:
+        if field not in data:
+            return f"Missing required field: {field}"
+    return None
+
+def finalize_paper(data, request_id, all_questions):
+    """Save the paper, render its PDF, upload it to S3 and return (paper_id, pdf_url)."""
+    paper_data = {
+        'request_id': str(request_id),
+        'questions': all_questions,
+        'created_at': datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%Y-%m-%d %H:%M:%S'),
+        'previous_paper_id': data.get('previous_paper_id')
+    }
+    paper_id = papers_collection.insert_one(paper_data).inserted_id
+
+    # Generate PDFs
+    pdf_filename = f"question_paper_{paper_id}.pdf"
+    pdf_buffer = CreatePDF.generate(
+        all_questions,
+        pdf_filename,
+        class_grade=data['classGrade'],
+        subject_name=data['subjectName']
+    )
+
+    s3_client.upload_fileobj(
+        pdf_buffer,
+        S3_BUCKET,
+        pdf_filename,
+        ExtraArgs={'ContentType': 'application/pdf'}
+    )
+
+    pdf_url = s3_client.generate_presigned_url(
+        'get_object',
+        Params={'Bucket': S3_BUCKET, 'Key': pdf_filename},
+        ExpiresIn=3600
+    )
+    return paper_id, pdf_url
+
+@app.route('/api/generate-questions', methods=['POST'])
+def generate_questions():
+    try:
+        logging.info("Received request at /api/generate-questions")
+        data = request.get_json()
+
+        error = validate_generation_request(data)
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
+        use_latest_note(data)
+
+        # Insert request metadata
+        data['created_at'] = datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%Y-%m-%d %H:%M:%S')
+        request_id = requests_collection.insert_one(data).inserted_id
+
+        # Generate questions for each topic in batches
+        await_ingestion(data)
+        batches = build_batches(data)
+        retrievals = prepare_retrieval(batches, data.get('allowPartialIndex', False))
+        concurrency = get_concurrency(data)
+        generation_start = time.perf_counter()
+        results = []
+        batch_timings = []
+        for batch, questions, timing in iter_batches(batches, retrievals, concurrency):
+            results.append((batch, questions))
+            batch_timings.append(timing)
+        batch_timings.sort(key=lambda timing: timing['batch'])
+        all_questions = assemble_questions(data['topics'], results, batch_timings)
+        logging.info(
+            f"Generated {len(batches)} batches with concurrency {concurrency} "
+            f"in {time.perf_counter() - generation_start:.2f}s"
+        )
+
+        paper_id, pdf_url = finalize_paper(data, request_id, all_questions)
 
         return jsonify({
             'success': True,
             'paper_id': str(paper_id),
             'questions': all_questions,
-            'pdf_url': pdf_url
+            'pdf_url': pdf_url,
+            'batch_timings': batch_timings
         })
 
     except Exception as e:
@@ -254,6 +625,169 @@ def generate_questions():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, default=str)}\n\n"
+
+@app.route('/api/generate-questions/stream', methods=['POST'])
+def generate_questions_stream():
+    """Streaming variant of /api/generate-questions using server-sent events.
+
+    Emits a `question` event per validated question as the model writes it,
+    a `batch` event as each batch completes (cached and bank batches only
+    send this one), then a final `done` event with the paper_id and PDF URL
+    (or `error`).
+    """
+    logging.info("Received request at /api/generate-questions/stream")
+    data = request.get_json(silent=True)
+
+    error = validate_generation_request(data)
+    if error:
+        return jsonify({'success': False, 'error': error}), 400
+    use_latest_note(data)
+
+    data['created_at'] = datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%Y-%m-%d %H:%M:%S')
+    request_id = requests_collection.insert_one(data).inserted_id
+
+    def generate():
+        try:
+            await_ingestion(data)
+            batches = build_batches(data)
+            retrievals = prepare_retrieval(batches, data.get('allowPartialIndex', False))
+            concurrency = get_concurrency(data)
+            yield sse_event('start', {
+                'request_id': str(request_id),
+                'total_batches': len(batches)
+            })
+
+            results = []
+            timings = []
+            for event in iter_batch_events(batches, retrievals, concurrency):
+                if event[0] == 'question':
+                    _, batch, question = event
+                    yield sse_event('question', {
+                        'batch': batch['index'],
+                        'topic_index': batch['topic_index'],
+                        'topic': batch['data'].get('sectionName', ''),
+                        'question': question
+                    })
+                    continue
+                _, batch, questions, timing = event
+                results.append((batch, questions))
+                timings.append(timing)
+                yield sse_event('batch', {
+                    'batch': batch['index'],
+                    'topic_index': batch['topic_index'],
+                    'topic': batch['data'].get('sectionName', ''),
+                    'questions': questions,
+                    'timing': timing,
+                    'completed': len(results),
+                    'total_batches': len(batches)
+                })
+
+            all_questions = assemble_questions(data['topics'], results, timings)
+            paper_id, pdf_url = finalize_paper(data, request_id, all_questions)
+
+            yield sse_event('done', {
+                'success': True,
+                'paper_id': str(paper_id),
+                'pdf_url': pdf_url
+            })
+        except Exception as e:
+            logging.error(f"Exception in /generate-questions/stream: {str(e)}")
+            yield sse_event('error', {'success': False, 'error': str(e)})
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Stop nginx from buffering the stream
+    return response
+
+
+# Background paper generation jobs
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+# A running job whose worker has not sent a heartbeat for this long is requeued
+JOB_STALE_AFTER = timedelta(seconds=int(os.getenv('JOB_STALE_SECONDS', 120)))
+job_queue = JobQueue(jobs_collection, max_workers=JOB_WORKERS, stale_after=JOB_STALE_AFTER) if db is not None else None
+
+def run_paper_job(job):
+    """Job handler: run the topic/batch pipeline, skipping batches already saved."""
+    data = job.payload
+
+    # Keep the batch plan stable across restarts so saved results still line up
+    batches = job.state.get('batches')
+    if not batches:
+        await_ingestion(data)
+        batches = job.set_state('batches', build_batches(data))
+    job.set_total(len(batches))
+
+    results = [(batch, job.results[str(batch['index'])])
+               for batch in batches if str(batch['index']) in job.results]
+    pending = [batch for batch in batches if str(batch['index']) not in job.results]
+    if results:
+        logging.info(f"Job {job.job_id}: reusing {len(results)} finished batches")
+
+    retrievals = prepare_retrieval(pending, data.get('allowPartialIndex', False))
+    for batch, questions, timing in iter_batches(pending, retrievals, get_concurrency(data)):
+        job.save_result(str(batch['index']), questions)
+        results.append((batch, questions))
+
+    all_questions = assemble_questions(data['topics'], results)
+    paper_id, pdf_url = finalize_paper(data, data.get('request_id'), all_questions)
+
+    return {
+        'paper_id': str(paper_id),
+        'pdf_url': pdf_url,
+        'questions': all_questions
+    }
+
+@app.route('/api/jobs', methods=['POST'])
+def create_job():
+    try:
+        data = request.get_json()
+
+        error = validate_generation_request(data)
+        if error:
+            return jsonify({'success': False, 'error': error}), 400
+        use_latest_note(data)
+
+        data['created_at'] = datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%Y-%m-%d %H:%M:%S')
+        request_id = requests_collection.insert_one(dict(data)).inserted_id
+        data['request_id'] = str(request_id)
+
+        job_id = job_queue.submit('paper', data)
+        logging.info(f"Queued paper job {job_id} for request {request_id}")
+
+        return jsonify({'success': True, 'job_id': job_id, 'status': 'queued'}), 202
+    except Exception as e:
+        logging.error(f"Exception in /api/jobs: {str(e)}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id) if job_queue else None
+    if not job:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+
+    return jsonify({
+        'success': True,
+        'job_id': str(job['_id']),
+        'status': job['status'],
+        'progress': job.get('progress', {}),
+        'result': job.get('result'),
+        'error': job.get('error')
+    })
+
+@app.route('/api/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify({'success': True, 'stats': question_cache.get_stats()})
+
+@app.route('/api/batch-stats', methods=['GET'])
+def batch_stats():
+    return jsonify({'success': True, 'mode': BATCH_MODE, 'stats': batch_planner.get_stats()})
+
+@app.route('/api/index-stats', methods=['GET'])
+def index_stats():
+    return jsonify({'success': True, 'stats': index_registry.get_stats(), 'memory_mb': round(monitor_memory(), 1)})
+
 @app.route('/api/download-pdf/<paper_id>', methods=['GET'])
 def download_pdf(paper_id):
     try:
@@ -278,6 +812,32 @@ def download_pdf(paper_id):
             'error': str(e)
         }), 500
 
+def keep_spool(spool_path, local_path):
+    """Move an upload's spool file to its content-addressed path, unless that copy already exists."""
+    if os.path.exists(local_path):
+        if os.path.exists(spool_path):
+            os.remove(spool_path)
+    elif os.path.exists(spool_path):
+        os.replace(spool_path, local_path)
+
+# Index fields a note shares with every other note of the same content
+SHARED_INDEX_FIELDS = ['vectorstore_path', 'chunk_count', 'sources', 'duplicates_removed',
+                       'embedding_model', 'indexed_at', 'index_version']
+
+def content_index_dir(content_hash):
+    return os.path.join(NOTES_INDEX_DIR, 'sha256', content_hash)
+
+def shared_index_note(content_hash):
+    """A note whose content-addressed index for this hash is built with the current embedding model."""
+    vectorstore_path = content_index_dir(content_hash)
+    if not os.path.isdir(vectorstore_path):
+        return None
+    return notes_collection.find_one({
+        'content_hash': content_hash,
+        'vectorstore_path': vectorstore_path,
+        'embedding_model': mylang4.document_processor.embedding_model
+    })
+
 @app.route('/api/upload-note', methods=['POST'])
 def upload_note():
     try:
@@ -285,67 +845,414 @@ def upload_note():
             return jsonify({'success': False, 'error': 'No file provided'}), 400
 
         file = request.files['file']
+        # Form parsing already spooled the file to disk and streamed it to S3
+        stream = file.stream
+        if not isinstance(stream, S3UploadStream):
+            return jsonify({'success': False, 'error': 'Note storage is unavailable'}), 503
+        for name, other in request.files.items(multi=True):
+            if other is not file and isinstance(other.stream, S3UploadStream):
+                other.stream.abort()
+
         if file.filename == '':
+            stream.abort()
             return jsonify({'success': False, 'error': 'No file selected'}), 400
 
         if not file.filename.lower().endswith('.pdf'):
+            stream.abort()
             return jsonify({'success': False, 'error': 'Only PDF files are allowed'}), 400
 
-        # Generate unique filename
-        filename = f"notes/{datetime.now().strftime('%Y%m%d_%H%M%S')}_{file.filename}"
-
-        temp_folder = 'temp_uploads'
-        os.makedirs(temp_folder, exist_ok=True)
-        local_path = os.path.join(temp_folder, 'latest.pdf')
-        logging.info(f"Saving file to: {local_path}")
-        file.save(local_path)
+        content_hash = stream.hexdigest()
+        local_path = os.path.join('temp_uploads', f'{content_hash}.pdf')
+        existing = notes_collection.find_one({'content_hash': content_hash}, sort=[('_id', 1)])
+        if existing:
+            # Same bytes as an earlier upload: drop this copy and point at the stored one
+            stream.abort(remove_spool=False)
+            keep_spool(stream.spool_path, local_path)
+            filename = existing['filename']
+            size = stream.size
+        else:
+            upload = stream.finish(key=f"notes/sha256/{content_hash}.pdf")
+            keep_spool(stream.spool_path, local_path)
+            filename = upload['key']
+            size = upload['size']
+        logging.info(f"Note {content_hash[:12]} stored at {local_path} and s3://{NOTES_BUCKET}/{filename}"
+                     f"{' (duplicate)' if existing else ''}")
 
-        # Upload to S3 (no metadata)
-        s3_client.upload_fileobj(
-            file,
-            NOTES_BUCKET,
-            filename,
-            ExtraArgs={'ContentType': 'application/pdf'}
-        )
-        logging.info(f"File uploaded to S3: {filename}")
         # Save note metadata to MongoDB
+        note_id = stream.note_id
         note_data = {
+            '_id': note_id,
             'filename': filename,
             'original_name': file.filename,
             'uploaded_at': datetime.now(pytz.timezone('Asia/Kolkata')).strftime('%Y-%m-%d %H:%M:%S'),
-            's3_url': f"s3://{NOTES_BUCKET}/{filename}"
+            's3_url': f"s3://{NOTES_BUCKET}/{filename}",
+            'local_path': local_path,
+            'content_hash': content_hash,
+            'size': size
         }
-        notes_collection = db['notes']
-        note_id = notes_collection.insert_one(note_data).inserted_id
+        indexed = shared_index_note(content_hash)
+        if indexed:
+            note_data.update({field: indexed[field] for field in SHARED_INDEX_FIELDS if field in indexed})
+        notes_collection.insert_one(note_data)
 
         return jsonify({
             'success': True,
             'note_id': str(note_id),
-            'filename': file.filename
+            'filename': file.filename,
+            'duplicate': bool(existing),
+            'indexed': bool(indexed)
         })
 
     except Exception as e:
         logging.info(f"Error uploading note: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+INGESTION_MODE = os.getenv('INGESTION_MODE', 'streaming')  # 'streaming' or 'batch'
+
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', 1))
+INGEST_CHECKPOINT_CHUNKS = int(os.getenv('INGEST_CHECKPOINT_CHUNKS', 512))
+INGEST_WAIT_SECONDS = int(os.getenv('INGEST_WAIT_SECONDS', 300))
+# Local copies of uploads and their extracted pages; both can be rebuilt, so the oldest are pruned
+UPLOAD_CACHE_MAX_BYTES = int(os.getenv('UPLOAD_CACHE_MAX_MB', 2048)) * 1024 * 1024
+PAGE_CACHE_MAX_BYTES = int(os.getenv('PAGE_CACHE_MAX_MB', 512)) * 1024 * 1024
+# Ingestion has its own small pool so long PDFs never hold up paper jobs
+ingest_queue = JobQueue(jobs_collection, max_workers=INGEST_WORKERS, stale_after=JOB_STALE_AFTER) if db is not None else None
+
+def partial_index_dir(vectorstore_path):
+    """Where an unfinished ingestion checkpoints the index built so far."""
+    return f"{vectorstore_path}.partial"
+
+def ingest_note(note, target, vectorstore_path, append, progress=None, job_id=None):
+    """Parse, split, embed and save a note into vectorstore_path; returns the analyse result."""
+    local_pdf_path = note.get('local_path') or os.path.join('temp_uploads', f"{note['_id']}.pdf")
+    if os.path.exists(local_pdf_path):
+        touch(local_pdf_path)
+    else:
+        # Another server may have taken the upload, or it was pruned; fetch it back from S3
+        os.makedirs(os.path.dirname(local_pdf_path), exist_ok=True)
+        s3_client.download_file(NOTES_BUCKET, note['filename'], local_pdf_path)
+
+    if append:
+        shared_path = target.get('vectorstore_path')
+        if shared_path and os.path.isdir(shared_path) and not os.path.isdir(vectorstore_path):
+            # Content-addressed indexes are shared between notes; grow a private copy
+            shutil.copytree(shared_path, vectorstore_path)
+
+    content_hash = note.get('content_hash')
+    source_id = content_hash or str(note['_id'])
+    os.makedirs(vectorstore_path, exist_ok=True)
+    ingest_options = {
+        'persist_directory': vectorstore_path,
+        'append': append,
+        'source_id': source_id,
+        'content_hash': content_hash,
+        'progress': progress
+    }
+    if INGESTION_MODE == 'streaming':
+        vectorstore, chunk_count = mylang4.document_processor.stream_uploaded_document(
+            local_pdf_path,
+            checkpoint_directory=partial_index_dir(vectorstore_path),
+            checkpoint_every=INGEST_CHECKPOINT_CHUNKS,
+            **ingest_options
+        )
+    else:
+        vectorstore, chunks = mylang4.document_processor.process_uploaded_document(local_pdf_path, **ingest_options)
+        chunk_count = len(chunks)
+    index_registry.put(vectorstore_path, vectorstore)
+
+    sources = mylang4.document_processor.read_sources(vectorstore_path)
+    # Every note sharing the rebuilt index, or waiting on this job for it, sees the new version
+    sharing = [{'_id': target['_id']}, {'vectorstore_path': vectorstore_path}]
+    if job_id:
+        sharing.append({'ingestion.job_id': job_id})
+    notes_collection.update_many({'$or': sharing}, {
+        '$set': {
+            'vectorstore_path': vectorstore_path,
+            'chunk_count': sum(source['chunks'] for source in sources.values()),
+            'sources': list(sources),
+            'duplicates_removed': vectorstore.duplicates_removed,
+            'embedding_model': mylang4.document_processor.embedding_model,
+            'indexed_at': datetime.utcnow()
+        },
+        '$inc': {'index_version': 1}
+    })
+
+    return {
+        'note_id': str(target['_id']),
+        'source_id': source_id,
+        'chunks': chunk_count,
+        'sources': list(sources),
+        'duplicates_removed': vectorstore.duplicates_removed
+    }
+
+def run_ingest_job(job):
+    """Job handler: index one note, reporting pages parsed and chunks embedded as it goes."""
+    payload = job.payload
+    note = get_note(payload['note_id'])
+    target = get_note(payload['target_id'])
+    if not note or not target:
+        raise ValueError('Note not found')
+
+    job_id = str(job.job_id)
+
+    def set_ingestion(**fields):
+        # The target and any note of the same content that asked meanwhile are linked by job id,
+        # so a job replaced by a reindex no longer touches them
+        notes_collection.update_many({'ingestion.job_id': job_id}, {
+            '$set': {f'ingestion.{key}': value for key, value in fields.items()}
+        })
+
+    def progress(**fields):
+        job.update_progress(**fields)
+        set_ingestion(**fields)
+
+    set_ingestion(status='running', started_at=datetime.utcnow())
+    partial_path = partial_index_dir(payload['vectorstore_path'])
+    try:
+        result = ingest_note(note, target, payload['vectorstore_path'], payload['append'], progress, job_id)
+    except Exception as e:
+        set_ingestion(status='failed', error=str(e))
+        raise
+    finally:
+        index_registry.invalidate(partial_path)
+        shutil.rmtree(partial_path, ignore_errors=True)
+        prune_local_caches()
+    set_ingestion(status='completed', finished_at=datetime.utcnow())
+    return result
+
+def prune_local_caches():
+    """Trim temp_uploads and the page cache to their budgets, sparing files of queued or running ingestions."""
+    try:
+        in_flight = [ObjectId(doc['payload']['note_id']) for doc in jobs_collection.find(
+            {'kind': 'ingest', 'status': {'$in': ['queued', 'running']}}, {'payload.note_id': 1})]
+        keep_hashes = {note['content_hash'] for note in notes_collection.find(
+            {'_id': {'$in': in_flight}}, {'content_hash': 1}) if note.get('content_hash')}
+        prune_directory('temp_uploads', UPLOAD_CACHE_MAX_BYTES, keep_hashes)
+        prune_directory(mylang4.document_processor.page_cache_dir, PAGE_CACHE_MAX_BYTES, keep_hashes)
+    except Exception as e:
+        logging.warning(f"Could not prune local caches: {e}")
+
+def await_ingestion(data):
+    """Block until the paper's notes finish indexing or the wait runs out.
+
+    Waits up to INGEST_WAIT_SECONDS by default whenever a referenced note is
+    queued or running. waitForIngestion may be a number of seconds instead,
+    or false to generate straight away; allowPartialIndex also skips the
+    wait, using whatever the ingestion has checkpointed so far.
+    """
+    wait = data.get('waitForIngestion', not data.get('allowPartialIndex', False))
+    if not wait:
+        return
+    timeout = INGEST_WAIT_SECONDS if isinstance(wait, bool) else min(float(wait), INGEST_WAIT_SECONDS)
+    note_ids = sorted({note_id for topic in data.get('topics', []) for note_id in topic_note_ids(data, topic)})
+    deadline = time.monotonic() + timeout
+    while note_ids:
+        notes = notes_collection.find({
+            '_id': {'$in': [ObjectId(note_id) for note_id in note_ids]},
+            'ingestion.status': {'$in': ['queued', 'running']}
+        })
+        # Only wait on jobs that are alive; an orphaned one is requeued by the job sweep
+        pending = 0
+        for note in notes:
+            ingestion = ingestion_state(note)
+            if ingestion.get('status') in ('queued', 'running') and not ingestion.get('stale'):
+                pending += 1
+        if not pending:
+            return
+        if time.monotonic() >= deadline:
+            logging.warning(f"Gave up waiting for {pending} note ingestions after {timeout}s")
+            return
+        time.sleep(1)
+
+def ingestion_state(note):
+    """The note's ingestion record, reconciled with its job so a lost or finished job never looks in flight.
+
+    An in-flight record whose job has stopped sending heartbeats is marked `stale`.
+    """
+    ingestion = dict(note.get('ingestion') or {})
+    if ingestion.get('status') not in ('queued', 'running') or not ingest_queue:
+        return ingestion
+    job = ingest_queue.get(ingestion['job_id']) if ingestion.get('job_id') else None
+    if job is None:
+        queued_at = ingestion.get('queued_at')
+        if queued_at and queued_at > datetime.utcnow() - timedelta(minutes=1):
+            return ingestion  # its job is still being submitted
+        status, error = 'failed', 'Ingestion job was lost'
+    elif job['status'] in ('queued', 'running'):
+        ingestion['status'] = job['status']
+        ingestion['stale'] = not ingest_queue.is_live(job)
+        return ingestion
+    else:
+        status, error = job['status'], job.get('error')
+    notes_collection.update_one({'_id': note['_id'], 'ingestion.job_id': ingestion.get('job_id')}, {
+        '$set': {'ingestion.status': status, 'ingestion.error': error}
+    })
+    ingestion.update(status=status, error=error)
+    return ingestion
+
 @app.route('/api/analyse-note', methods=['POST'])
 def analyse_note():
     try:
-        local_pdf_path = 'temp_uploads/latest.pdf'
-        if not os.path.exists(local_pdf_path):
-            return jsonify({'success': False, 'error': 'No PDF found to analyze'}), 400
+        data = request.get_json(silent=True) or {}
+        note_id = data.get('note_id')
+        if note_id:
+            note = get_note(note_id)
+        else:
+            # Fall back to the most recent upload
+            note = notes_collection.find_one(sort=[('_id', -1)])
+        if not note:
+            return jsonify({'success': False, 'error': 'Note not found'}), 404
 
-        vectorstore_path = f'vectorstores/latest'
-        os.makedirs(vectorstore_path, exist_ok=True)
-        vectorstore, chunks = mylang4.document_processor.process_uploaded_document(local_pdf_path, persist_directory=vectorstore_path)
+        content_hash = note.get('content_hash')
+        append = bool(data.get('append_to'))
+        if content_hash and not append and not data.get('reindex'):
+            # An identical file was indexed already: share its index instead of re-embedding
+            indexed = shared_index_note(content_hash)
+            if indexed:
+                shared = {field: indexed[field] for field in SHARED_INDEX_FIELDS if field in indexed}
+                notes_collection.update_one({'_id': note['_id']}, {'$set': {**shared, 'analysed_at': datetime.utcnow()}})
+                return jsonify({
+                    'success': True,
+                    'note_id': str(note['_id']),
+                    'source_id': content_hash,
+                    'chunks': indexed.get('chunk_count'),
+                    'sources': indexed.get('sources', []),
+                    'duplicates_removed': indexed.get('duplicates_removed', 0),
+                    'reused': True
+                })
 
-        
+        # append_to adds this note's chunks to another note's index, embedding only the new pages
+        source_id = content_hash or str(note['_id'])
+        target = note
+        if append:
+            target = get_note(data['append_to'])
+            if not target:
+                return jsonify({'success': False, 'error': 'Target note not found'}), 404
+            if target.get('embedding_model') not in (None, mylang4.document_processor.embedding_model):
+                return jsonify({'success': False, 'error': 'Target index uses a different embedding model'}), 409
+            if source_id in target.get('sources', []):
+                return jsonify({'success': False, 'error': 'This file is already in the target index'}), 409
+            vectorstore_path = os.path.join(NOTES_INDEX_DIR, str(target['_id']))
+        elif content_hash:
+            vectorstore_path = content_index_dir(content_hash)
+        else:
+            vectorstore_path = os.path.join(NOTES_INDEX_DIR, str(note['_id']))
 
-        return jsonify({'success': True})
+        # Papers that name no notes draw on the most recently analysed one
+        notes_collection.update_one({'_id': target['_id']}, {'$set': {'analysed_at': datetime.utcnow()}})
+
+        # A note already being ingested is followed, not queued twice; a stalled job is replaced
+        ingestion = ingestion_state(target)
+        if ingestion.get('status') in ('queued', 'running') and not ingestion.get('stale'):
+            return jsonify({
+                'success': True,
+                'note_id': str(target['_id']),
+                'job_id': ingestion.get('job_id'),
+                'status': ingestion['status']
+            }), 202
+
+        payload = {
+            'note_id': str(note['_id']),
+            'target_id': str(target['_id']),
+            'vectorstore_path': vectorstore_path,
+            'append': append
+        }
+        for _ in range(3):
+            job_id = ObjectId()
+            notes_collection.update_one({'_id': target['_id']}, {'$set': {'ingestion': {
+                'status': 'queued',
+                'job_id': str(job_id),
+                'source_id': source_id,
+                'vectorstore_path': vectorstore_path,
+                'pages_parsed': 0,
+                'chunks_embedded': 0,
+                'queued_at': datetime.utcnow()
+            }}})
+            try:
+                # The claim is the index directory, so notes sharing a content-addressed index never ingest into it at once
+                job_id = ingest_queue.submit('ingest', payload, claim=vectorstore_path, job_id=job_id)
+                break
+            except DuplicateKeyError:
+                running = ingest_queue.claimed_by(vectorstore_path)
+                if running is None:
+                    continue  # released meanwhile
+                if not ingest_queue.is_live(running):
+                    ingest_queue.supersede(running['_id'], 'Worker stopped sending heartbeats')
+                    continue
+                # Follow the job already building this index; its updates reach every note linked by job_id
+                notes_collection.update_one({'_id': target['_id']}, {'$set': {
+                    'ingestion.job_id': str(running['_id']),
+                    'ingestion.status': running['status']
+                }})
+                return jsonify({
+                    'success': True,
+                    'note_id': str(target['_id']),
+                    'job_id': str(running['_id']),
+                    'status': running['status']
+                }), 202
+        else:
+            return jsonify({'success': False, 'error': 'Index is busy, try again'}), 409
+        logging.info(f"Queued ingestion job {job_id} for note {note['_id']}")
+
+        return jsonify({
+            'success': True,
+            'note_id': str(target['_id']),
+            'source_id': source_id,
+            'job_id': job_id,
+            'status': 'queued'
+        }), 202
     except Exception as e:
         logging.info(f"Error in analyse_note: {e}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/notes/<note_id>/ingestion', methods=['GET'])
+def note_ingestion_status(note_id):
+    note = get_note(note_id)
+    if not note:
+        return jsonify({'success': False, 'error': 'Note not found'}), 404
+
+    ingestion = ingestion_state(note)
+    job = ingest_queue.get(ingestion['job_id']) if ingest_queue and ingestion.get('job_id') else None
+    if job:
+        ingestion['result'] = job.get('result')
+        ingestion['error'] = job.get('error')
+    return jsonify({
+        'success': True,
+        'note_id': note_id,
+        'indexed': bool(note.get('vectorstore_path')),
+        'chunk_count': note.get('chunk_count'),
+        'ingestion': ingestion
+    })
+
+@app.route('/api/notes/<note_id>/sources/<source_id>', methods=['DELETE'])
+def remove_note_source(note_id, source_id):
+    try:
+        note = get_note(note_id)
+        if not note or not note.get('vectorstore_path'):
+            return jsonify({'success': False, 'error': 'Note index not found'}), 404
+
+        vectorstore_path = note['vectorstore_path']
+        try:
+            vectorstore, removed = mylang4.document_processor.remove_source(vectorstore_path, source_id)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
+        index_registry.put(vectorstore_path, vectorstore)
+
+        sources = mylang4.document_processor.read_sources(vectorstore_path)
+        notes_collection.update_one({'_id': note['_id']}, {
+            '$set': {
+                'chunk_count': sum(source['chunks'] for source in sources.values()),
+                'sources': list(sources),
+                'indexed_at': datetime.utcnow()
+            },
+            '$inc': {'index_version': 1}
+        })
+
+        return jsonify({'success': True, 'note_id': note_id, 'removed_chunks': removed, 'sources': list(sources)})
+    except Exception as e:
+        logging.info(f"Error in remove_note_source: {e}")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.errorhandler(404)
 def not_found(e):
     return jsonify({"error": "Resource not found"}), 404
@@ -354,6 +1261,21 @@ def not_found(e):
 def server_error(e):
     return jsonify({"error": "Internal server error"}), 500
 
+# Resume queued jobs only once every handler and helper they call is defined
+if job_queue:
+    job_queue.register('paper', run_paper_job)
+    try:
+        job_queue.resume()
+    except Exception as e:
+        logging.warning(f"Could not resume pending jobs: {e}")
+
+if ingest_queue:
+    ingest_queue.register('ingest', run_ingest_job)
+    try:
+        ingest_queue.resume()
+    except Exception as e:
+        logging.warning(f"Could not resume pending ingestions: {e}")
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     logging.info(f"🚀 Server starting on http://localhost:{port}")
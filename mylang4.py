@@ -1,17 +1,33 @@
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
+from langchain_openai import ChatOpenAI
 from langchain_community.vectorstores import FAISS
-from langchain.chains import LLMChain
 from langchain_core.prompts import PromptTemplate
+from langchain_core.documents import Document
 import os    
 from dotenv import load_dotenv
-from typing import Dict, List, Any, Optional, Tuple
+from typing import Dict, List, Any, Iterator, Optional, Tuple
 import logging
 import tiktoken
 import json
 import re
+import queue
+import shutil
+import threading
+import time
+import numpy as np
+from functools import lru_cache
 from langchain.callbacks import get_openai_callback
+from Utility.embedding_cache import CachedEmbeddings
+from Utility.embeddings import get_embeddings
+from Utility.tokenizer import OfflineEncoder
+from Utility.pdf_extract import iter_pdf_pages
+from Utility.mmap_index import MmapVectorIndex, create_generation, publish_generation, write_json_atomic
+from Utility.quantized_index import QuantizedVectorIndex
+from Utility.bm25 import BM25Builder, BM25Index
+from Utility.dedup import ChunkDeduplicator
+from Utility.context_compression import compress_context
+from Utility.file_cache import touch
 
 # Load environment variables
 load_dotenv()
@@ -20,38 +36,701 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+SOURCES_FILE = 'sources.json'
+FAISS_POINTER = 'faiss.json'
+
+def tokenizer_name() -> str:
+    """TOKENIZER picks 'tiktoken' or 'offline'; offline embedding backends default to the offline counter."""
+    default = 'tiktoken' if os.getenv('EMBEDDING_BACKEND', 'openai') == 'openai' else 'offline'
+    return os.getenv('TOKENIZER', default)
+
+@lru_cache(maxsize=None)
+def get_encoder(model: str = "gpt-4"):
+    """Shared token encoder, built once per model.
+
+    tiktoken downloads its vocabulary on first use, so deployments without
+    network access count tokens with OfflineEncoder instead.
+    """
+    if tokenizer_name() == 'offline':
+        return OfflineEncoder()
+    return tiktoken.encoding_for_model(model)
+
+def count_tokens(text: str, model: str = "gpt-4") -> int:
+    return len(get_encoder(model).encode(text))
+
+# Longer texts, such as the whole pages the splitter measures first, are never seen twice
+CACHED_TOKEN_TEXT_CHARS = 2048
+
+@lru_cache(maxsize=4096)
+def _memoised_count_tokens(text: str, model: str) -> int:
+    return count_tokens(text, model)
+
+def cached_count_tokens(text: str, model: str = "gpt-4") -> int:
+    """count_tokens memoised for the chunk-sized pieces the splitter measures repeatedly."""
+    if len(text) > CACHED_TOKEN_TEXT_CHARS:
+        return count_tokens(text, model)
+    return _memoised_count_tokens(text, model)
+
+def truncate_to_tokens(text: str, max_tokens: int = 1000, model: str = "gpt-4") -> str:
+    enc = get_encoder(model)
+    tokens = enc.encode(text)
+    truncated_tokens = tokens[:max_tokens]
+    return enc.decode(truncated_tokens)
+
+def chunk_tokens(doc: Any, model: str = "gpt-4") -> int:
+    """Token count stored on the chunk at ingestion, computed only for older indexes."""
+    token_count = doc.metadata.get('token_count')
+    if token_count is None:
+        token_count = count_tokens(doc.page_content.strip(), model)
+    return token_count
+
+def pack_context(docs: List[Any], max_tokens: int = 1000, model: str = "gpt-4") -> str:
+    """Join whole retrieved chunks, in rank order, until the token budget is full."""
+    parts = []
+    used = 0
+    for doc in docs:
+        separator = 1 if parts else 0  # the joining newline
+        tokens = chunk_tokens(doc, model)
+        if used + separator + tokens > max_tokens:
+            if not parts:
+                # A single oversized chunk still contributes what fits
+                parts.append(truncate_to_tokens(doc.page_content.strip(), max_tokens, model))
+            break
+        parts.append(doc.page_content.strip())
+        used += separator + tokens
+    return "\n".join(parts)
+
 class DocumentProcessor:
-    def __init__(self):
-        self.embeddings = OpenAIEmbeddings()
+    def __init__(self, index_type: Optional[str] = None, embedding_backend: Optional[str] = None):
+        # EMBEDDING_BACKEND picks 'openai' or an offline backend such as 'hashing'
+        base_embeddings = get_embeddings(embedding_backend)
+        self.embedding_model = getattr(base_embeddings, 'model', type(base_embeddings).__name__)
+        if getattr(base_embeddings, 'is_local', False):
+            self.embeddings = base_embeddings
+        else:
+            # Remote chunk embeddings are cached on disk, keyed by text hash and model
+            self.embeddings = CachedEmbeddings(
+                base_embeddings,
+                cache_dir=os.getenv('EMBEDDING_CACHE_DIR', 'embedding_cache'),
+                max_bytes=int(os.getenv('EMBEDDING_CACHE_MAX_MB', 512)) * 1024 * 1024
+            )
+        # Chunks are sized in tokens. With CONTEXT_COMPRESSION off, 4 chunks of
+        # 249 plus their joining newlines fill RetrievalContext's 1000-token
+        # budget exactly; compression packs sentences instead, so size only
+        # matters for retrieval granularity there
+        self.chunk_size_tokens = int(os.getenv('CHUNK_TOKENS', 249))
         self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=1000,
-            chunk_overlap=200,
-            length_function=len,
+            chunk_size=self.chunk_size_tokens,
+            chunk_overlap=int(os.getenv('CHUNK_OVERLAP_TOKENS', 50)),
+            length_function=cached_count_tokens,
             separators=["\n\n", "\n", " ", ""]
         )
+        # 'parallel' spreads pypdf text extraction over a process pool
+        self.extraction = os.getenv('PDF_EXTRACTION', 'parallel')
+        self.extract_workers = int(os.getenv('PDF_EXTRACT_WORKERS', 0)) or None
+        # Shorter PDFs are extracted in the calling thread
+        self.extract_min_pages = int(os.getenv('PDF_PARALLEL_MIN_PAGES', 100))
+        # 'faiss' (pickled docstore) or 'mmap' (raw vectors, no pickle, shared page cache)
+        self.index_format = os.getenv('INDEX_FORMAT', 'faiss')
+        self.index_dtype = os.getenv('INDEX_DTYPE', 'float32')
+        # 'flat', or a quantized type from QuantizedVectorIndex.INDEX_TYPES for large corpora
+        self.index_type = index_type or os.getenv('INDEX_TYPE', 'flat')
+        self.rerank_factor = int(os.getenv('INDEX_RERANK_FACTOR', 4))
+        # Recall/latency report for quantized indexes; costly on large corpora, so off by default
+        self.index_report = os.getenv('INDEX_REPORT', 'off') == 'on'
+        # Estimated Jaccard similarity above which a chunk counts as a duplicate; 0 disables
+        self.dedup_threshold = float(os.getenv('DEDUP_THRESHOLD', 0.8))
+        # Extracted page text keyed by the PDF's sha256, reused when the same file is indexed again
+        self.page_cache_dir = os.getenv('PAGE_CACHE_DIR', 'page_cache')
     
-    def process_uploaded_document(self, pdf_path, persist_directory=None) -> Tuple[Any, List[Any]]:
+    def iter_pages(self, pdf_path, content_hash: Optional[str] = None) -> Iterator[Any]:
+        """Page Documents in order, from the page cache, the parallel extractor or PyPDFLoader."""
+        if content_hash:
+            return self.cached_pages(pdf_path, content_hash)
+        return self.extract_pages(pdf_path)
+
+    def extract_pages(self, pdf_path) -> Iterator[Any]:
+        if self.extraction == 'parallel':
+            return iter_pdf_pages(pdf_path, max_workers=self.extract_workers, min_pages=self.extract_min_pages)
+        return PyPDFLoader(pdf_path).lazy_load()
+
+    def cached_pages(self, pdf_path, content_hash: str) -> Iterator[Any]:
+        path = os.path.join(self.page_cache_dir, f"{content_hash}.jsonl")
+        if os.path.exists(path):
+            touch(path)
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    record = json.loads(line)
+                    record['metadata']['source'] = pdf_path
+                    yield Document(page_content=record['page_content'], metadata=record['metadata'])
+            return
+
+        os.makedirs(self.page_cache_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        complete = False
         try:
-            loader = PyPDFLoader(pdf_path)
-            pages = loader.load()
-            texts = self.text_splitter.split_documents(pages)
-            
-            vectorstore = FAISS.from_documents(
-                documents=texts,
-                embedding=self.embeddings
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for page in self.extract_pages(pdf_path):
+                    f.write(json.dumps({'page_content': page.page_content, 'metadata': page.metadata}, default=str) + '\n')
+                    yield page
+            # Renamed into place only once every page is written
+            os.replace(tmp_path, path)
+            complete = True
+        finally:
+            if not complete and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def split_documents(self, docs: List[Any]) -> List[Any]:
+        """Split pages into chunks of at most `chunk_size_tokens` tokens.
+
+        The splitter adds up the token counts of the pieces it merges, which
+        can be off by a token or two at the joins, so the rare chunk over the
+        limit is cut at token boundaries.
+        """
+        chunks = []
+        for chunk in self.text_splitter.split_documents(docs):
+            text = chunk.page_content.strip()
+            if cached_count_tokens(text) <= self.chunk_size_tokens:
+                chunks.append(chunk)
+                continue
+            enc = get_encoder()
+            tokens = enc.encode(text)
+            for start in range(0, len(tokens), self.chunk_size_tokens):
+                chunks.append(Document(
+                    page_content=enc.decode(tokens[start:start + self.chunk_size_tokens]),
+                    metadata=dict(chunk.metadata)
+                ))
+        return chunks
+
+    def prepare_chunks(self, docs: List[Any]) -> List[Any]:
+        for doc in docs:
+            doc.metadata['token_count'] = cached_count_tokens(doc.page_content.strip())
+        return docs
+
+    def new_deduplicator(self, merge_pages: bool = True) -> Optional[ChunkDeduplicator]:
+        if not self.dedup_threshold:
+            return None
+        return ChunkDeduplicator(threshold=self.dedup_threshold, merge_pages=merge_pages)
+
+    def save_vectorstore(self, vectorstore: Any, persist_directory: Optional[str] = None) -> Any:
+        """Save in the configured format and return the index to serve queries from.
+
+        Every format writes a new generation directory and swaps a pointer
+        file, so requests searching the old index are never disturbed. The
+        other formats' files go only after the new index is in place.
+        """
+        persist_directory = persist_directory or "./faiss_index"
+        if self.index_type != 'flat':
+            index = QuantizedVectorIndex.from_faiss(
+                vectorstore, persist_directory, index_type=self.index_type, rerank_factor=self.rerank_factor,
+                report=self.index_report)
+            self.remove_faiss(persist_directory)
+            return index
+        if self.index_format == 'mmap':
+            index = MmapVectorIndex.from_faiss(vectorstore, persist_directory, dtype=self.index_dtype)
+            self.remove_faiss(persist_directory)
+            return index
+        self.save_faiss(vectorstore, persist_directory)
+        MmapVectorIndex.remove(persist_directory)
+        vectorstore.memory_bytes = self.faiss_bytes(persist_directory)
+        return vectorstore
+
+    @staticmethod
+    def save_faiss(vectorstore: Any, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        generation = create_generation(directory, prefix='faiss')
+        vectorstore.save_local(os.path.join(directory, generation))
+        publish_generation(directory, FAISS_POINTER, {'generation': generation}, prefix='faiss')
+        MmapVectorIndex.remove_files(directory, ['index.faiss', 'index.pkl'])
+
+    @staticmethod
+    def faiss_path(directory: str) -> Optional[str]:
+        """Directory holding the current index.faiss/index.pkl pair, if any."""
+        pointer = os.path.join(directory, FAISS_POINTER)
+        if os.path.exists(pointer):
+            with open(pointer, 'r', encoding='utf-8') as f:
+                return os.path.join(directory, json.load(f)['generation'])
+        if os.path.exists(os.path.join(directory, 'index.faiss')):
+            return directory  # saved before generations
+        return None
+
+    @classmethod
+    def faiss_bytes(cls, directory: str) -> int:
+        """A loaded FAISS store is about as large as its saved files."""
+        path = cls.faiss_path(directory)
+        if not path:
+            return 0
+        return sum(os.path.getsize(os.path.join(path, name)) for name in ('index.faiss', 'index.pkl')
+                   if os.path.exists(os.path.join(path, name)))
+
+    @staticmethod
+    def remove_faiss(directory: str) -> None:
+        """Drop a FAISS index so a re-analysed note is never read in the old format."""
+        MmapVectorIndex.remove_files(directory, [FAISS_POINTER, 'index.faiss', 'index.pkl'])
+        for name in os.listdir(directory):
+            if name.startswith('faiss-') and os.path.isdir(os.path.join(directory, name)):
+                shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+    def load_index(self, persist_directory: str) -> Any:
+        if QuantizedVectorIndex.is_quantized_index(persist_directory):
+            index = QuantizedVectorIndex(persist_directory, self.embeddings)
+        elif MmapVectorIndex.is_mmap_index(persist_directory):
+            index = MmapVectorIndex(persist_directory, self.embeddings)
+        else:
+            index = FAISS.load_local(self.faiss_path(persist_directory) or persist_directory, self.embeddings,
+                                     allow_dangerous_deserialization=True)
+            index.memory_bytes = self.faiss_bytes(persist_directory)
+        # The BM25 index rides along with the vector index it was built beside
+        index.bm25 = BM25Index.load(persist_directory, self.lexical_documents(index))
+        return index
+
+    @staticmethod
+    def lexical_documents(index: Any) -> Any:
+        """Row number -> Document, so BM25 postings can point into the vector index instead of copying texts."""
+        if isinstance(index, MmapVectorIndex):
+            return index.document
+        return lambda i: index.docstore.search(index.index_to_docstore_id[i])
+
+    def save_lexical_index(self, index: Any, bm25: BM25Builder, persist_directory: Optional[str] = None) -> Any:
+        persist_directory = persist_directory or "./faiss_index"
+        bm25.save(persist_directory)
+        index.bm25 = BM25Index.load(persist_directory, self.lexical_documents(index))
+        return index
+
+    @staticmethod
+    def read_sources(persist_directory: str) -> Dict[str, Any]:
+        """Manifest of the source files an index holds: source_id -> {'filename', 'chunks', 'added_at'}."""
+        path = os.path.join(persist_directory, SOURCES_FILE)
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    @staticmethod
+    def write_sources(persist_directory: str, sources: Dict[str, Any]) -> None:
+        write_json_atomic(os.path.join(persist_directory, SOURCES_FILE), sources)
+
+    def record_source(self, persist_directory: str, source_id: str, pdf_path: str,
+                      chunk_count: int, append: bool) -> Dict[str, Any]:
+        sources = self.read_sources(persist_directory) if append else {}
+        sources[source_id] = {
+            'filename': os.path.basename(pdf_path),
+            'chunks': chunk_count,
+            'added_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        }
+        self.write_sources(persist_directory, sources)
+        return sources
+
+    def editable_index(self, persist_directory: str) -> Optional[Any]:
+        """The saved index as a FAISS store that can take new or deleted vectors.
+
+        FAISS indexes load as they are. The mmap and quantized formats keep
+        full-precision vectors on disk, so they are rebuilt from those
+        without calling the embedding model again.
+        """
+        if not os.path.isdir(persist_directory):
+            return None
+        if MmapVectorIndex.is_mmap_index(persist_directory):
+            index = MmapVectorIndex(persist_directory, self.embeddings)
+            if not index.count:
+                return None
+            docs = [index.document(i) for i in range(index.count)]
+            vectors = np.asarray(index.vectors, dtype=np.float32).tolist()
+            return FAISS.from_embeddings(
+                list(zip([doc.page_content for doc in docs], vectors)),
+                self.embeddings,
+                metadatas=[doc.metadata for doc in docs]
             )
+        faiss_path = self.faiss_path(persist_directory)
+        if faiss_path:
+            return FAISS.load_local(faiss_path, self.embeddings, allow_dangerous_deserialization=True)
+        return None
+
+    def open_for_append(self, persist_directory: Optional[str], append: bool) -> Tuple[Optional[Any], BM25Builder]:
+        persist_directory = persist_directory or "./faiss_index"
+        if not append:
+            return None, BM25Builder()
+        vectorstore = self.editable_index(persist_directory)
+        if vectorstore is None:
+            return None, BM25Builder()
+        saved = BM25Index.load(persist_directory)
+        if saved is not None and len(saved) == len(vectorstore.index_to_docstore_id):
+            return vectorstore, BM25Builder.from_index(saved)
+        # Saved before BM25 or in the old JSON format: build it once from the stored chunks
+        return vectorstore, self.rebuild_lexical_index(vectorstore)
+
+    def rebuild_lexical_index(self, vectorstore: Any) -> BM25Builder:
+        bm25 = BM25Builder()
+        documents = self.lexical_documents(vectorstore)
+        bm25.add_documents(documents(i) for i in range(len(vectorstore.index_to_docstore_id)))
+        return bm25
+
+    def remove_source(self, persist_directory: str, source_id: str) -> Tuple[Any, int]:
+        """Delete one source file's chunks from an index; returns the index and chunks removed."""
+        sources = self.read_sources(persist_directory)
+        if source_id not in sources:
+            raise ValueError(f"Source {source_id} is not in this index")
+        if len(sources) == 1:
+            raise ValueError("Cannot remove the only source of an index")
+
+        vectorstore = self.editable_index(persist_directory)
+        if vectorstore is None:
+            raise ValueError(f"No index found at {persist_directory}")
+        ids = [doc_id for doc_id in vectorstore.index_to_docstore_id.values()
+               if vectorstore.docstore.search(doc_id).metadata.get('source_id') == source_id]
+        if ids:
+            vectorstore.delete(ids)
+
+        # Deleting renumbers the remaining rows, so postings are rebuilt to match
+        bm25 = self.rebuild_lexical_index(vectorstore)
+
+        index = self.save_vectorstore(vectorstore, persist_directory)
+        index = self.save_lexical_index(index, bm25, persist_directory)
+        del sources[source_id]
+        self.write_sources(persist_directory, sources)
+        logger.info(f"Removed {len(ids)} chunks of source {source_id} from {persist_directory}")
+        return index, len(ids)
+
+    @staticmethod
+    def tag_source(docs: List[Any], source_id: Optional[str]) -> List[Any]:
+        if source_id:
+            for doc in docs:
+                doc.metadata['source_id'] = source_id
+        return docs
+
+    def process_uploaded_document(self, pdf_path, persist_directory=None, append: bool = False,
+                                  source_id: Optional[str] = None, content_hash: Optional[str] = None,
+                                  progress: Optional[Any] = None) -> Tuple[Any, List[Any]]:
+        """Index a PDF. With `append`, only its chunks are embedded and added to the existing index."""
+        try:
+            source_id = source_id or os.path.basename(pdf_path)
+            vectorstore, bm25 = self.open_for_append(persist_directory, append)
+            pages = list(self.iter_pages(pdf_path, content_hash))
+            if progress:
+                progress(pages_parsed=len(pages), chunks_embedded=0)
+            texts = self.split_documents(pages)
+            deduplicator = self.new_deduplicator()
+            if deduplicator:
+                texts = deduplicator.filter(texts)
+            texts = self.tag_source(self.prepare_chunks(texts), source_id)
             
-            if persist_directory:
-                vectorstore.save_local(persist_directory)
+            if vectorstore is None:
+                vectorstore = FAISS.from_documents(
+                    documents=texts,
+                    embedding=self.embeddings
+                )
             else:
-                vectorstore.save_local("./faiss_index")
+                vectorstore.add_documents(texts)
+            bm25.add_documents(texts)
+            if progress:
+                progress(pages_parsed=len(pages), chunks_embedded=len(texts))
             
-            logger.info(f"Processed PDF '{pdf_path}' into {len(texts)} chunks")
+            vectorstore = self.save_vectorstore(vectorstore, persist_directory)
+            vectorstore = self.save_lexical_index(vectorstore, bm25, persist_directory)
+            self.record_source(persist_directory or "./faiss_index", source_id, pdf_path, len(texts), append)
+            vectorstore.duplicates_removed = deduplicator.removed if deduplicator else 0
+            
+            logger.info(f"Processed PDF '{pdf_path}' into {len(texts)} chunks, "
+                        f"{vectorstore.duplicates_removed} near-duplicates removed")
             return vectorstore, texts
         except Exception as e:
             logger.error(f"Error processing document: {str(e)}")
             raise
 
+    def stream_uploaded_document(self, pdf_path, persist_directory=None,
+                                 batch_size: int = 64, max_pending_batches: int = 4,
+                                 append: bool = False, source_id: Optional[str] = None,
+                                 content_hash: Optional[str] = None, progress: Optional[Any] = None,
+                                 checkpoint_directory: Optional[str] = None,
+                                 checkpoint_every: int = 512) -> Tuple[Any, int]:
+        """Ingest a PDF page by page with bounded memory.
+
+        A parser thread extracts pages lazily and splits them into chunk
+        batches while this thread embeds earlier batches and adds them to
+        the index. At most `max_pending_batches` batches wait in between.
+        With `append`, the batches go into the existing index instead of a
+        new one. Returns the vectorstore and the number of chunks indexed.
+
+        `progress(pages_parsed=..., chunks_embedded=...)` is called after
+        every batch. With `checkpoint_directory`, the index built so far is
+        saved there as a FAISS index after the first `checkpoint_every` chunks
+        and then each time the index has doubled, so it can be searched
+        before ingestion finishes.
+        """
+        source_id = source_id or os.path.basename(pdf_path)
+        # Kept chunks may already be embedding, so duplicates are only dropped here
+        deduplicator = self.new_deduplicator(merge_pages=False)
+        pending = queue.Queue(maxsize=max_pending_batches)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    pending.put(item, timeout=0.5)
+                    return
+                except queue.Full:
+                    continue
+
+        pages_parsed = 0
+
+        def parse_pages():
+            nonlocal pages_parsed
+            pages = self.iter_pages(pdf_path, content_hash)
+            try:
+                batch = []
+                for page in pages:
+                    if stop.is_set():
+                        # The consumer failed; stop extracting pages nobody will read
+                        return
+                    pages_parsed += 1
+                    chunks = self.split_documents([page])
+                    if deduplicator:
+                        chunks = deduplicator.filter(chunks)
+                    batch.extend(self.tag_source(self.prepare_chunks(chunks), source_id))
+                    while len(batch) >= batch_size:
+                        put(batch[:batch_size])
+                        batch = batch[batch_size:]
+                if batch:
+                    put(batch)
+                put(None)
+            except Exception as e:
+                put(e)
+            finally:
+                # Shuts down the extraction workers and drops a partial page cache file
+                if hasattr(pages, 'close'):
+                    pages.close()
+
+        parser = threading.Thread(target=parse_pages, name="pdf-parser", daemon=True)
+        parser.start()
+
+        chunk_count = 0
+        next_checkpoint = checkpoint_every
+        try:
+            vectorstore, bm25 = self.open_for_append(persist_directory, append)
+            while True:
+                item = pending.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                texts = [doc.page_content for doc in item]
+                metadatas = [doc.metadata for doc in item]
+                text_embeddings = list(zip(texts, self.embeddings.embed_documents(texts)))
+                if vectorstore is None:
+                    vectorstore = FAISS.from_embeddings(text_embeddings, self.embeddings, metadatas=metadatas)
+                else:
+                    vectorstore.add_embeddings(text_embeddings, metadatas=metadatas)
+                bm25.add_documents(item)
+                chunk_count += len(item)
+                if progress:
+                    progress(pages_parsed=pages_parsed, chunks_embedded=chunk_count)
+                if checkpoint_directory and chunk_count >= next_checkpoint:
+                    self.save_faiss(vectorstore, checkpoint_directory)
+                    bm25.save(checkpoint_directory)
+                    # Each checkpoint rewrites the whole index, so the gap doubles with its size
+                    # to keep the total written within about twice the final index
+                    next_checkpoint = chunk_count + max(checkpoint_every, vectorstore.index.ntotal)
+
+            if not chunk_count:
+                raise ValueError(f"No text could be extracted from '{pdf_path}'")
+
+            vectorstore = self.save_vectorstore(vectorstore, persist_directory)
+            vectorstore = self.save_lexical_index(vectorstore, bm25, persist_directory)
+            self.record_source(persist_directory or "./faiss_index", source_id, pdf_path, chunk_count, append)
+            vectorstore.duplicates_removed = deduplicator.removed if deduplicator else 0
+            logger.info(f"Streamed PDF '{pdf_path}' into {chunk_count} chunks, "
+                        f"{vectorstore.duplicates_removed} near-duplicates removed")
+            return vectorstore, chunk_count
+        except Exception as e:
+            logger.error(f"Error processing document: {str(e)}")
+            raise
+        finally:
+            stop.set()
+            parser.join(timeout=5)
+
+class RetrievalContext:
+    """Request-scoped retrieval context shared by every batch of a paper.
+
+    Searches one or more note indexes. Each topic's context is fetched
+    once; `prefetch` embeds all topic queries of the paper in a single
+    batched embedding call.
+
+    In 'hybrid' mode, indexes that carry a BM25 index are searched both
+    lexically and by vector and the rankings are fused. A topic whose
+    name appears literally in the notes takes a lexical-only fast path
+    that needs no embedding call at all.
+
+    With CONTEXT_COMPRESSION=tfidf, `candidates` chunks are retrieved
+    instead of k and the budget is filled with their most relevant
+    sentences rather than with whole chunks.
+    """
+
+    RRF_K = 60
+
+    def __init__(self, vectorstores: Any, k: int = 4, max_tokens: int = 1000, mode: Optional[str] = None):
+        self.vectorstores = vectorstores if isinstance(vectorstores, list) else [vectorstores]
+        self.k = k
+        self.max_tokens = max_tokens
+        self.mode = mode or os.getenv('RETRIEVAL_MODE', 'hybrid')  # 'hybrid' or 'vector'
+        self.lexical_indexes = [vs.bm25 for vs in self.vectorstores if getattr(vs, 'bm25', None)]
+        self.compression = os.getenv('CONTEXT_COMPRESSION', 'tfidf')  # 'tfidf' or 'off'
+        self.fetch_k = int(os.getenv('COMPRESSION_CANDIDATES', 12)) if self.compression == 'tfidf' else k
+        self._contexts: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def query_for(topic_data: Dict[str, Any]) -> str:
+        return f"{topic_data['subjectName']} {topic_data['sectionName']}"
+
+    @property
+    def embeddings(self) -> Any:
+        return getattr(self.vectorstores[0], 'embeddings', None)
+
+    @property
+    def hybrid(self) -> bool:
+        return self.mode == 'hybrid' and bool(self.lexical_indexes)
+
+    def search(self, vector: List[float], k: Optional[int] = None) -> List[Any]:
+        """Top-k chunks across all indexes by distance to the query vector."""
+        k = k or self.k
+        scored = []
+        for vectorstore in self.vectorstores:
+            scored.extend(vectorstore.similarity_search_with_score_by_vector(vector, k=k))
+        scored.sort(key=lambda item: item[1])
+        return [doc for doc, _ in scored[:k]]
+
+    def lexical_search(self, query: str, k: Optional[int] = None) -> List[Any]:
+        k = k or self.k
+        scored = []
+        for bm25 in self.lexical_indexes:
+            scored.extend(bm25.search(query, k=k))
+        scored.sort(key=lambda item: item[1], reverse=True)
+        return [doc for doc, _ in scored[:k]]
+
+    def lexical_fast_path(self, topic_data: Dict[str, Any]) -> Optional[List[Any]]:
+        """BM25-only results when the topic name occurs verbatim in the notes, else None."""
+        if not self.hybrid:
+            return None
+        section = str(topic_data.get('sectionName', ''))
+        if not any(bm25.contains_phrase(section) for bm25 in self.lexical_indexes):
+            return None
+        return self.lexical_search(self.query_for(topic_data), k=self.fetch_k)
+
+    def retrieve(self, query: str, vector: List[float]) -> List[Any]:
+        if not self.hybrid:
+            return self.search(vector, k=self.fetch_k)
+
+        # Reciprocal rank fusion of the vector and BM25 rankings
+        fused: Dict[str, List[Any]] = {}
+        for ranking in (self.search(vector, k=2 * self.fetch_k), self.lexical_search(query, k=2 * self.fetch_k)):
+            for rank, doc in enumerate(ranking):
+                entry = fused.setdefault(doc.page_content, [0.0, doc])
+                entry[0] += 1.0 / (self.RRF_K + rank + 1)
+        ranked = sorted(fused.values(), key=lambda entry: entry[0], reverse=True)
+        return [doc for _, doc in ranked[:self.fetch_k]]
+
+    def build(self, query: str, docs: List[Any]) -> str:
+        if self.compression == 'tfidf':
+            return compress_context(query, docs, self.max_tokens, count_tokens)
+        return pack_context(docs, max_tokens=self.max_tokens)
+
+    def prefetch(self, topics: List[Dict[str, Any]]) -> None:
+        pending: Dict[str, Dict[str, Any]] = {}
+        lexical = 0
+        for topic in topics:
+            query = self.query_for(topic)
+            if query in self._contexts or query in pending:
+                continue
+            docs = self.lexical_fast_path(topic)
+            if docs is not None:
+                self._contexts[query] = self.build(query, docs)
+                lexical += 1
+            else:
+                pending[query] = topic
+
+        if not pending or self.embeddings is None:
+            return
+        try:
+            queries = list(pending)
+            vectors = self.embeddings.embed_documents(queries)
+            for query, vector in zip(queries, vectors):
+                self._contexts[query] = self.build(query, self.retrieve(query, vector))
+            logger.info(f"Prefetched context for {len(queries)} topics with one embedding call "
+                        f"({lexical} served lexically)")
+        except Exception as e:
+            logger.error(f"Error prefetching context: {e}")
+
+    def get(self, topic_data: Dict[str, Any]) -> str:
+        query = self.query_for(topic_data)
+        with self._lock:
+            if query not in self._contexts:
+                try:
+                    docs = self.lexical_fast_path(topic_data)
+                    if docs is None:
+                        docs = self.retrieve(query, self.embeddings.embed_query(query))
+                    self._contexts[query] = self.build(query, docs)
+                except Exception as e:
+                    logger.error(f"Error getting context: {e}")
+                    return ""
+            return self._contexts[query]
+
+class QuestionStreamParser:
+    """Incrementally pulls question objects out of a streamed {"questions": [...]} reply.
+
+    Feed it text as it arrives; every object in the questions array is
+    returned as soon as its closing brace is seen.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.string_start = None
+        self.last_string = None
+        self.array_depth = None
+        self.object_start = None
+
+    def feed(self, text: str) -> List[Dict[str, Any]]:
+        self.buffer += text
+        completed = []
+        while self.pos < len(self.buffer):
+            ch = self.buffer[self.pos]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                    self.last_string = self.buffer[self.string_start:self.pos]
+            elif ch == '"':
+                self.in_string = True
+                self.string_start = self.pos + 1
+            elif ch in "{[":
+                if ch == "[" and self.array_depth is None and self.last_string == "questions":
+                    self.array_depth = self.depth + 1
+                elif ch == "{" and self.array_depth is not None and self.depth == self.array_depth:
+                    self.object_start = self.pos
+                self.depth += 1
+            elif ch in "}]":
+                self.depth -= 1
+                if ch == "}" and self.object_start is not None and self.depth == self.array_depth:
+                    raw = self.buffer[self.object_start:self.pos + 1]
+                    self.object_start = None
+                    completed.append(json.loads(raw))
+                elif ch == "]" and self.array_depth is not None and self.depth < self.array_depth:
+                    self.array_depth = -1  # questions array closed; ignore anything after it
+            self.pos += 1
+
+        # Drop consumed text unless an object is still being read
+        if self.object_start is None and not self.in_string:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        return completed
+
 class QuestionGenerator:
     def __init__(self):
         self.llm = ChatOpenAI(
@@ -119,106 +798,120 @@ class QuestionGenerator:
             ],
             template=self.question_template
         )
-        
-        self.chain = LLMChain(llm=self.llm, prompt=self.prompt)
     
-    def generate_questions(self, topic_data: Dict[str, Any], vectorstore: Any) -> Dict[str, Any]:
-        try:
-            
+    def build_context(self, topic_data: Dict[str, Any], vectorstore: Any) -> str:
+        # Reuse the request's retrieval context when one is passed in
+        if isinstance(vectorstore, RetrievalContext):
+            return vectorstore.get(topic_data)
+
+        # Get context from vectorstore
+        context = ""
+        if vectorstore:
+            try:
+                # Perform similarity search
+                docs = vectorstore.similarity_search(
+                    f"{topic_data['subjectName']} {topic_data['sectionName']}",
+                    k=4
+                )
+
+                # Pack whole chunks up to the token limit using their stored counts
+                context = pack_context(docs, max_tokens=1000, model="gpt-4")
+
+                logger.info(f"Using context from vectorstore (packed): {context[:200]}...")
+            except Exception as e:
+                logger.error(f"Error getting context: {e}")
+        return context
+
+    def prompt_inputs(self, topic_data: Dict[str, Any], context: str) -> Dict[str, Any]:
+        return {
+            "context": context,
+            "num_questions": topic_data['numQuestions'],
+            "question_type": topic_data['questionType'],
+            "subject": topic_data['subjectName'],
+            "class_grade": topic_data['classGrade'],
+            "topic": topic_data['sectionName'],
+            "difficulty": topic_data['difficulty'],
+            "bloom_level": topic_data['bloomLevel'],
+            "instructions": topic_data.get('additionalInstructions', '')
+        }
 
-            def truncate_to_tokens(text: str, max_tokens: int = 1000, model: str = "gpt-4") -> str:
-                enc = tiktoken.encoding_for_model(model)
-                tokens = enc.encode(text)
-                truncated_tokens = tokens[:max_tokens]
-                return enc.decode(truncated_tokens)
+    @staticmethod
+    def validate_question(i: int, q: Any) -> None:
+        if not isinstance(q, dict):
+            raise ValueError(f"Question {i} is not a dictionary")
 
-            # Get context from vectorstore
-            context = ""
-            if vectorstore:
+        required_fields = ['question', 'options', 'answer', 'explanation']
+        missing_fields = [field for field in required_fields if field not in q]
+        if missing_fields:
+            raise ValueError(f"Question {i} missing fields: {missing_fields}")
+
+        if not isinstance(q['options'], list) or len(q['options']) != 4:
+            raise ValueError(f"Question {i} must have exactly 4 options")
+
+        if q['answer'] not in q['options']:
+            raise ValueError(f"Question {i} answer must be one of the options")
+
+    @staticmethod
+    def parse_output(llm_output: str) -> Dict[str, Any]:
+        """Parse a complete reply; used when incremental parsing found nothing."""
+        try:
+            # Remove any markdown code block markers
+            if llm_output.startswith('```'):
+                llm_output = llm_output.split('```')[1]
+            if llm_output.startswith('json'):
+                llm_output = llm_output[4:]
+            llm_output = llm_output.strip()
+
+            result = json.loads(llm_output)
+        except json.JSONDecodeError as e:
+            logger.error(f"Failed to parse JSON: {e}")
+            # Try to extract JSON object
+            match = re.search(r'\{[\s\S]*\}', llm_output)
+            if match:
                 try:
-                    # Perform similarity search
-                    docs = vectorstore.similarity_search(
-                        f"{topic_data['subjectName']} {topic_data['sectionName']}",
-                        k=4
-                    )
+                    result = json.loads(match.group(0))
+                except json.JSONDecodeError:
+                    raise ValueError("Invalid JSON format in response")
+            else:
+                raise ValueError("No valid JSON found in response")
 
-                    # Combine retrieved documents
-                    raw_context = "\n".join(doc.page_content.strip() for doc in docs)
+        # Validate response
+        if not isinstance(result, dict) or 'questions' not in result:
+            raise ValueError("Invalid response format: missing 'questions' key")
 
-                    # Truncate using token limit
-                    context = truncate_to_tokens(raw_context, max_tokens=1000, model="gpt-4")
+        if not isinstance(result['questions'], list):
+            raise ValueError("'questions' must be a list")
+        return result
 
-                    logger.info(f"Using context from vectorstore (truncated): {context[:200]}...")
-                except Exception as e:
-                    logger.error(f"Error getting context: {e}")
+    def stream_questions(self, topic_data: Dict[str, Any], vectorstore: Any) -> Iterator[Dict[str, Any]]:
+        """Stream the completion and yield each validated question as its object closes."""
+        context = self.build_context(topic_data, vectorstore)
+        prompt_text = self.prompt.format(**self.prompt_inputs(topic_data, context))
 
+        parser = QuestionStreamParser()
+        chunks = []
+        count = 0
+        for chunk in self.llm.stream(prompt_text):
+            text = chunk.content if hasattr(chunk, 'content') else str(chunk)
+            chunks.append(text)
+            for q in parser.feed(text):
+                self.validate_question(count, q)
+                count += 1
+                yield q
 
-            
-            
-            # Generate questions
-            response = self.chain.invoke({
-                "context": context,
-                "num_questions": topic_data['numQuestions'],
-                "question_type": topic_data['questionType'],
-                "subject": topic_data['subjectName'],
-                "class_grade": topic_data['classGrade'],
-                "topic": topic_data['sectionName'],
-                "difficulty": topic_data['difficulty'],
-                "bloom_level": topic_data['bloomLevel'],
-                "instructions": topic_data.get('additionalInstructions', '')
-            })
-            
-            # Parse response
-            llm_output = response['text'] if isinstance(response, dict) and 'text' in response else response
-            logger.info(f"Raw LLM output: {llm_output}")
-            
-            # Clean and parse JSON
-            try:
-                # Remove any markdown code block markers
-                if llm_output.startswith('```'):
-                    llm_output = llm_output.split('```')[1]
-                if llm_output.startswith('json'):
-                    llm_output = llm_output[4:]
-                llm_output = llm_output.strip()
-                
-                result = json.loads(llm_output)
-            except json.JSONDecodeError as e:
-                logger.error(f"Failed to parse JSON: {e}")
-                # Try to extract JSON object
-                match = re.search(r'\{[\s\S]*\}', llm_output)
-                if match:
-                    try:
-                        result = json.loads(match.group(0))
-                    except json.JSONDecodeError:
-                        raise ValueError("Invalid JSON format in response")
-                else:
-                    raise ValueError("No valid JSON found in response")
-            
-            # Validate response
-            if not isinstance(result, dict) or 'questions' not in result:
-                raise ValueError("Invalid response format: missing 'questions' key")
-            
-            if not isinstance(result['questions'], list):
-                raise ValueError("'questions' must be a list")
-            
-            # Validate each question
-            for i, q in enumerate(result['questions']):
-                if not isinstance(q, dict):
-                    raise ValueError(f"Question {i} is not a dictionary")
-                
-                required_fields = ['question', 'options', 'answer', 'explanation']
-                missing_fields = [field for field in required_fields if field not in q]
-                if missing_fields:
-                    raise ValueError(f"Question {i} missing fields: {missing_fields}")
-                
-                if not isinstance(q['options'], list) or len(q['options']) != 4:
-                    raise ValueError(f"Question {i} must have exactly 4 options")
-                
-                if q['answer'] not in q['options']:
-                    raise ValueError(f"Question {i} answer must be one of the options")
-            
-            return result
-            
+        llm_output = "".join(chunks)
+        logger.info(f"Raw LLM output: {llm_output}")
+
+        # Fall back to whole-reply parsing if the stream never produced a questions array
+        if count == 0:
+            for q in self.parse_output(llm_output)['questions']:
+                self.validate_question(count, q)
+                count += 1
+                yield q
+
+    def generate_questions(self, topic_data: Dict[str, Any], vectorstore: Any) -> Dict[str, Any]:
+        try:
+            return {'questions': list(self.stream_questions(topic_data, vectorstore))}
         except Exception as e:
             logger.error(f"Error generating questions: {e}")
             raise
@@ -79,6 +79,8 @@ const App: React.FC = () => {
   const [analysing, setAnalysing] = useState(false);
   const [analysisSuccess, setAnalysisSuccess] = useState(false);
   const [analysisMessage, setAnalysisMessage] = useState<string | null>(null);
+  // The central upload supplies note context to every topic of the paper
+  const [noteId, setNoteId] = useState<string | null>(null);
 
   // Watch intelligence type values for each topic
   // const topics = watch('topics');
@@ -112,10 +114,9 @@ const App: React.FC = () => {
       const result = await response.json();
 
       if (result.success) {
-        // Update the topic's noteId
-        const updatedTopics = [...fields];
-        updatedTopics[topicIndex].noteId = result.note_id;
-        // You might want to show a success message here
+        setNoteId(result.note_id);
+        setAnalysisSuccess(false);
+        setAnalysisMessage(null);
       } else {
         alert('Failed to upload file: ' + result.error);
       }
@@ -127,6 +128,28 @@ const App: React.FC = () => {
     }
   };
 
+  // Analysis runs as a background job; poll the note until its ingestion finishes
+  const waitForIngestion = async (noteId: string) => {
+    while (true) {
+      await new Promise(resolve => setTimeout(resolve, 1500));
+      const response = await fetch(`/api/notes/${noteId}/ingestion`);
+      const result = await response.json();
+      if (!result.success) {
+        throw new Error(result.error || 'Analysis failed');
+      }
+      const ingestion = result.ingestion || {};
+      if (ingestion.status === 'completed') {
+        return;
+      }
+      if (ingestion.status === 'failed') {
+        throw new Error(ingestion.error || 'Analysis failed');
+      }
+      setAnalysisMessage(
+        `Analysing... ${ingestion.pages_parsed || 0} pages read, ${ingestion.chunks_embedded || 0} chunks indexed`
+      );
+    }
+  };
+
   const handleAnalyse = async () => {
     setAnalysing(true);
     setAnalysisSuccess(false);
@@ -135,10 +158,14 @@ const App: React.FC = () => {
       const response = await fetch('/api/analyse-note', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ note_id: fields[0].noteId }),
+        body: JSON.stringify({ note_id: noteId }),
       });
       const result = await response.json();
       if (result.success) {
+        if (result.status === 'queued' || result.status === 'running') {
+          setAnalysisMessage('Analysing...');
+          await waitForIngestion(result.note_id);
+        }
         setAnalysisSuccess(true);
         setAnalysisMessage('Analysis complete!');
       } else {
@@ -147,7 +174,7 @@ const App: React.FC = () => {
       }
     } catch (e) {
       setAnalysisSuccess(false);
-      setAnalysisMessage('Analysis failed');
+      setAnalysisMessage(e instanceof Error ? e.message : 'Analysis failed');
     }
     setAnalysing(false);
   };
@@ -157,7 +184,7 @@ const App: React.FC = () => {
       const response = await fetch('/api/generate-questions', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify(data),
+        body: JSON.stringify(noteId ? { ...data, noteIds: [noteId] } : data),
       });
 
       if (!response.ok) {
@@ -223,13 +250,13 @@ const App: React.FC = () => {
               <label htmlFor="file-upload-central" className="file-upload-button">
                 {uploadingFiles[0] ? 'Uploading...' : 'Choose File'}
               </label>
-              {fields[0].noteId && (
+              {noteId && (
                 <span className="file-upload-success">✓ File uploaded successfully</span>
               )}
               <button
                 type="button"
                 onClick={handleAnalyse}
-                disabled={!fields[0].noteId || analysing}
+                disabled={!noteId || analysing}
                 style={{ marginLeft: 10 }}
               >
                 {analysing ? 'Analysing...' : 'Analyse'}